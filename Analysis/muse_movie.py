@@ -19,27 +19,29 @@ from matplotlib import cm
 
 import imageio
 
+from muse_slab_pipeline import section_reader, slab_map
+
 # Some things we'll be doing throw runtimewarnings that we won't care about.
 warnings.filterwarnings('ignore')
 
 
-def makeMovie(cube, redshift, center, name, thresh=None, frames=30, scalefactor=3.0, contsub=False, whitebg=False, linear=False):
-    '''Make the movie'''
+def makeMovie(cube, redshift, center, name, thresh=None, frames=30, scalefactor=3.0, contsub=False, whitebg=False, linear=False, slab=16, nworkers=0):
+    '''Make the movie. The channels of the movie are read in slabs of slab
+    channels by a muse_slab_pipeline, which prepares the next frames on
+    nworkers threads (0: one per CPU) while the current ones are plotted.'''
 
-    # Read the data cube
-    hdulist = fits.open(cube)
+    # Open the data cube, the channels are read as they are needed.
+    hdulist = fits.open(cube, memmap=False)
 
-    data = hdulist[0].data
-    header = hdulist[0].header
+    hdu = hdulist[0]
 
     # Most pipeline cubes will have data in 1st extension.
-    if data is None:
-        data = hdulist[1].data
-        header = hdulist[1].header
+    if hdu.header['NAXIS'] == 0:
+        hdu = hdulist[1]
 
-    hdulist.close()
+    header = hdu.header
 
-    number_of_channels = len(data[:, 0, 0])
+    number_of_channels = header['NAXIS3']
 
     # Create the wavelength array
     wavelength = ((np.arange(number_of_channels) + 1.0) -
@@ -57,10 +59,8 @@ def makeMovie(cube, redshift, center, name, thresh=None, frames=30, scalefactor=
     center_channel = (np.abs(wavelength - center)).argmin()
     #print("Emission line centroid for {} is in channel {}".format(name,center_channel))
 
-    movie_start = center_channel - frames
-    movie_end = center_channel + frames
-
-    slices_of_interest = np.arange(movie_start, movie_end, 1)
+    movie_start = max(center_channel - frames, 0)
+    movie_end = min(center_channel + frames, number_of_channels)
 
     # Create and scrub the temporary framestore directory
     temp_movie_dir = "framestore/"
@@ -78,18 +78,25 @@ def makeMovie(cube, redshift, center, name, thresh=None, frames=30, scalefactor=
     print("Making movie for {} at z={}. Line centroid is in channel {}".format(
         name, round(redshift, 3), center_channel))
 
-    for i, slice in enumerate(slices_of_interest):
+    if contsub is True:
+        continuum = hdu.section[(center_channel - 200) % number_of_channels]
+
+    def prepare_frames(start, stop, slab_data):
         # Perform a dumb continuum subtraction.
         # Risky if you land on another line.
         if contsub is True:
-            final_image_data = data[slice, :, :] - \
-                data[center_channel - 200, :, :]
-        elif contsub is False:
-            final_image_data = data[slice, :, :]
+            slab_data = slab_data - continuum
 
         if thresh is not None:
-            final_image_data[final_image_data < thresh] = np.nan
+            slab_data[slab_data < thresh] = np.nan
 
+        return slab_data
+
+    frame_images = (image for start, stop, images in
+                    slab_map(section_reader(hdu), prepare_frames, movie_start, movie_end, slab, nworkers)
+                    for image in images)
+
+    for i, final_image_data in enumerate(frame_images):
         sizes = np.shape(final_image_data)
         height = float(sizes[0]) * scalefactor
         width = float(sizes[1]) * scalefactor
@@ -123,6 +130,8 @@ def makeMovie(cube, redshift, center, name, thresh=None, frames=30, scalefactor=
         png_files.append(temp_movie_dir + '{}'.format(i) + '.png')
         plt.close(fig)
 
+    hdulist.close()
+
     # Create and scrub the GIF directory
     gif_output_dir = "movies/"
     if not os.path.exists(gif_output_dir):
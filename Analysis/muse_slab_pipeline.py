@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# Slab pipeline for reductions over the wavelength axis of a data cube.
+#
+# A reader thread reads the cube in slabs of consecutive wavelength channels
+# and keeps a few of them prefetched, while a pool of worker threads applies
+# a function to each slab. The results come back in slab order, so anything
+# combined from them does not depend on the thread scheduling.
+#
+# Usage:
+#
+#   hdulist = fits.open(cube, memmap=False)
+#   read = section_reader(hdulist[0])
+#   for start, stop, result in slab_map(read, func, 0, nwave, slab=256):
+#       ...
+#
+# NumPy and the scipy.sparse products release the GIL in their inner loops,
+# so the worker threads run in parallel on the bulk of the work.
+#
+
+from __future__ import print_function
+
+import collections
+import threading
+from multiprocessing import cpu_count
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+
+def slab_ranges(start, stop, slab):
+    '''Return the (start, stop) ranges of the slabs covering the channels
+    start:stop.'''
+
+    return [(first, min(first + slab, stop)) for first in range(start, stop, slab)]
+
+
+def channel_ranges(channels, slab):
+    '''Return the (start, stop) ranges of slabs of at most slab channels that
+    cover the given channel indices, split at the gaps between them, so that
+    only the needed channels are read.'''
+
+    channels = np.unique(channels)
+    gaps = np.nonzero(np.diff(channels) > 1)[0] + 1
+    ranges = []
+    for run in np.split(channels, gaps):
+        if len(run):
+            ranges.extend(slab_ranges(int(run[0]), int(run[-1]) + 1, slab))
+    return ranges
+
+
+def section_reader(*hdus):
+    '''Return read(start, stop), which reads the channels start:stop of the
+    given image HDUs through their sections, so that only the slab is read
+    from the file. With a single HDU the slab is returned as an array,
+    otherwise as a tuple of arrays.'''
+
+    def read(start, stop):
+        slabs = tuple(hdu.section[start:stop] for hdu in hdus)
+        if len(slabs) == 1:
+            return slabs[0]
+        return slabs
+
+    return read
+
+
+def _read_slabs(read, ranges, slabs, stop_event):
+    '''Reader thread of slab_map: puts (first, last, slab) into the bounded
+    queue slabs, followed by None, or by the exception raised by read.'''
+
+    try:
+        for first, last in ranges:
+            if stop_event.is_set():
+                return
+            slabs.put((first, last, read(first, last)))
+        slabs.put(None)
+    except Exception as error:
+        slabs.put(error)
+
+
+def _run_tasks(tasks):
+    '''Worker thread of slab_map: runs the (func, args, done, result) tasks
+    until it gets None, appending (True, value) or (False, exception) to
+    result and setting the event done.'''
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        func, args, done, result = task
+        try:
+            result.append((True, func(*args)))
+        except Exception as error:
+            result.append((False, error))
+        done.set()
+
+
+def slab_map(read, func, start, stop, slab=256, nworkers=0, prefetch=2):
+    '''Apply func(start, stop, data) to the slabs data = read(start, stop) of
+    the channels start:stop of a cube.
+
+    Yields (start, stop, result) in slab order. A background thread reads up
+    to prefetch slabs ahead while nworkers threads (0: number of cpus) run
+    func, so at most prefetch + nworkers + 1 slabs are held in memory.'''
+
+    return map_slabs(read, func, slab_ranges(start, stop, slab), nworkers, prefetch)
+
+
+def map_slabs(read, func, ranges, nworkers=0, prefetch=2):
+    '''slab_map for an explicit list of (start, stop) slab ranges, e.g. from
+    channel_ranges.'''
+
+    if nworkers <= 0:
+        nworkers = cpu_count()
+    slabs = queue.Queue(maxsize=max(prefetch, 1))
+    stop_event = threading.Event()
+    reader = threading.Thread(target=_read_slabs, args=(read, ranges, slabs, stop_event))
+    reader.daemon = True
+    reader.start()
+
+    tasks = queue.Queue()
+    for i in range(nworkers):
+        worker = threading.Thread(target=_run_tasks, args=(tasks,))
+        worker.daemon = True
+        worker.start()
+    pending = collections.deque()
+    try:
+        exhausted = False
+        while not exhausted or pending:
+            # keep every worker busy before waiting for the oldest slab
+            while not exhausted and len(pending) < nworkers:
+                item = slabs.get()
+                if item is None:
+                    exhausted = True
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    first, last, data = item
+                    done, result = threading.Event(), []
+                    tasks.put((func, (first, last, data), done, result))
+                    pending.append((first, last, done, result))
+            if pending:
+                first, last, done, result = pending.popleft()
+                done.wait()
+                ok, value = result[0]
+                if not ok:
+                    raise value
+                yield first, last, value
+    finally:
+        stop_event.set()
+        # unblock the reader if it waits for a free place in the queue
+        while reader.is_alive():
+            try:
+                slabs.get_nowait()
+            except queue.Empty:
+                reader.join(0.01)
+        for i in range(nworkers):
+            tasks.put(None)
+
+
+def slab_reduce(read, func, combine, start, stop, slab=256, nworkers=0, prefetch=2):
+    '''Reduce the slabs of the channels start:stop of a cube: func(start,
+    stop, data) gives the partial result of each slab and combine(total,
+    partial) merges them in slab order, starting from the first slab.'''
+
+    total = None
+    for first, last, partial in slab_map(read, func, start, stop, slab, nworkers, prefetch):
+        total = partial if total is None else combine(total, partial)
+    return total
+
+
+def slab_moments(start, stop, data):
+    '''Count, mean and sum of squared deviations along the wavelength axis of
+    one slab (NaNs count as zero, as in the continuum images).'''
+
+    data = np.nan_to_num(np.array(data, dtype=np.float64), copy=False)
+    mean = data.mean(axis=0)
+    return data.shape[0], mean, ((data - mean)**2).sum(axis=0)
+
+
+def merge_moments(a, b):
+    '''Merge the moments of two sets of channels (Chan et al. 1979).'''
+
+    na, mean_a, m2_a = a
+    nb, mean_b, m2_b = b
+    n = na + nb
+    delta = mean_b - mean_a
+    return n, mean_a + delta*(float(nb)/n), m2_a + m2_b + delta**2*(float(na)*nb/n)
+
+
+def band_mean_std(read, start, stop, slab=256, nworkers=0, prefetch=2):
+    '''Mean and standard deviation over the wavelength axis of the channels
+    start:stop returned by read, with NaNs counted as zero.
+
+    The moments of each slab are merged in slab order with the pairwise
+    update of Chan et al., in double precision, and returned as float32.'''
+
+    n, mean, m2 = slab_reduce(read, slab_moments, merge_moments, start, stop, slab,
+                              nworkers, prefetch)
+    return mean.astype(np.float32), np.sqrt(m2/n).astype(np.float32)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Spaxel-major store of a data cube for fast access to single spectra.
+#
+# FITS cubes are stored wavelength-major, so reading one spectrum touches
+# every wavelength plane of the file. convert_cube transposes the data and
+# variance of a cube into a directory with
+#
+#   data.npy     float32 array (ny*nx, nwave), spectrum of spaxel (x, y) in
+#                row y*nx + x
+#   var.npy      the same for the variance
+#   header.txt   FITS header of the data extension (WCS of the cube)
+#   index.json   shape, extensions and files of the store
+#
+# and open_store memory maps it, so that single spectra and blocks of
+# spectra are returned as views without reading the rest of the cube.
+#
+# Usage:  python muse_spaxel_store.py cube.fits store_dir [slab [nworkers]]
+#
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+
+import numpy as np
+from astropy.io import fits
+from numpy.lib.format import open_memmap
+
+from muse_slab_pipeline import section_reader, slab_map
+
+
+def cube_extensions(hdulist):
+    '''Return the indices of the data and variance extensions of a cube:
+    DATA and STAT for MUSE pipeline cubes with an empty primary HDU, the
+    primary HDU and the first extension otherwise.'''
+
+    if hdulist[0].header['NAXIS'] == 0:
+        names = [hdu.name for hdu in hdulist]
+        data = names.index('DATA') if 'DATA' in names else 1
+        var = names.index('STAT') if 'STAT' in names else data + 1
+        return data, var
+    return 0, 1
+
+
+def convert_cube(cube, store, slab=64, nworkers=0):
+    '''Write the spaxel-major store of a cube (see the header of this module)
+    to the directory store. The cube is read in slabs of slab channels by a
+    muse_slab_pipeline, which transposes them on nworkers threads (0: one per
+    CPU), so the cube is never held in memory.'''
+
+    hdulist = fits.open(cube, memmap=False)
+    ext_data, ext_var = cube_extensions(hdulist)
+    header = hdulist[ext_data].header
+    nwave, ny, nx = header['NAXIS3'], header['NAXIS2'], header['NAXIS1']
+
+    if not os.path.exists(store):
+        os.makedirs(store)
+    data = open_memmap(os.path.join(store, 'data.npy'), mode='w+', dtype=np.float32,
+                       shape=(ny*nx, nwave))
+    var = open_memmap(os.path.join(store, 'var.npy'), mode='w+', dtype=np.float32,
+                      shape=(ny*nx, nwave))
+
+    def transpose(start, stop, slabs):
+        return tuple(np.ascontiguousarray(s.reshape(stop - start, ny*nx).T, dtype=np.float32)
+                     for s in slabs)
+
+    read = section_reader(hdulist[ext_data], hdulist[ext_var])
+    for start, stop, (slab_data, slab_var) in slab_map(read, transpose, 0, nwave, slab, nworkers):
+        data[:, start:stop] = slab_data
+        var[:, start:stop] = slab_var
+    data.flush()
+    var.flush()
+    del data, var
+
+    header.totextfile(os.path.join(store, 'header.txt'), overwrite=True)
+    index = {'cube': os.path.abspath(cube), 'extensions': [ext_data, ext_var],
+             'shape': [ny, nx, nwave], 'data': 'data.npy', 'var': 'var.npy',
+             'header': 'header.txt'}
+    with open(os.path.join(store, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    hdulist.close()
+
+
+def open_store(store):
+    '''Open a spaxel-major store read-only and return a dict with the memory
+    mapped 'data' and 'var' arrays (ny*nx, nwave), the 'header' of the cube,
+    its 'wave'length axis and the 'shape' (ny, nx, nwave).'''
+
+    with open(os.path.join(store, 'index.json')) as f:
+        index = json.load(f)
+    header = fits.Header.fromtextfile(os.path.join(store, index['header']))
+    ny, nx, nwave = index['shape']
+    wave = ((np.arange(nwave) + 1. - header.get('CRPIX3', 1.)) *
+            header.get('CD3_3', header.get('CDELT3', 1.)) + header['CRVAL3'])
+    return {'data': np.load(os.path.join(store, index['data']), mmap_mode='r'),
+            'var': np.load(os.path.join(store, index['var']), mmap_mode='r'),
+            'header': header, 'wave': wave, 'shape': (ny, nx, nwave)}
+
+
+def spectrum(store, x, y):
+    '''Data and variance spectrum of the spaxel (x, y), as views.'''
+
+    row = y*store['shape'][1] + x
+    return store['data'][row], store['var'][row]
+
+
+def block(store, y0, y1, x0=0, x1=None):
+    '''Data and variance spectra of the spaxels y0:y1, x0:x1 as views of
+    shape (y1 - y0, x1 - x0, nwave). Full rows (x0 = 0, x1 = None) are
+    contiguous in the store.'''
+
+    ny, nx, nwave = store['shape']
+    return tuple(store[key][y0*nx:y1*nx].reshape(-1, nx, nwave)[:, x0:x1]
+                 for key in ('data', 'var'))
+
+
+def spectra(store, x, y):
+    '''Data and variance spectra (len(x), nwave) of the spaxels x, y, as
+    copies.'''
+
+    rows = np.asarray(y)*store['shape'][1] + np.asarray(x)
+    return store['data'][rows], store['var'][rows]
+
+
+def main():
+
+    if len(sys.argv) < 3:
+        print('usage: python muse_spaxel_store.py cube.fits store_dir [slab [nworkers]]')
+        sys.exit(1)
+    convert_cube(*([sys.argv[1], sys.argv[2]] + [int(arg) for arg in sys.argv[3:5]]))
+
+
+if __name__ == '__main__':
+    main()
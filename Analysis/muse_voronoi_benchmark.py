@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+#
+# Timing benchmarks for the adaptive binning code in muse_voronoi_bin.py, the
+# bin extraction in voronoi_bins.py, the slab pipeline in muse_slab_pipeline.py
+# and the spaxel-major store in muse_spaxel_store.py
+#
+# Usage:  python muse_voronoi_benchmark.py [bin_cube] [neighborlist]
+#                                          [coarse [signal.fits noise.fits]]
+#                                          [quadtree]
+#                                          [slab_pipeline [nwave [n]]]
+#                                          [spaxel_store [nwave [n]] [--drop-caches]]
+#
+# Arguments following a benchmark name are passed on to that benchmark, an
+# option --name as the keyword name=True. The page cache of the system is
+# only dropped for cold reads with spaxel_store --drop-caches (needs root and
+# flushes the cache of the whole machine), otherwise all timings are warm.
+#
+
+from __future__ import print_function
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+from astropy.io import fits
+
+import muse_slab_pipeline
+import muse_spaxel_store
+import muse_voronoi_bin
+import voronoi_bins
+
+
+def circular_mask(n, seed=1):
+    '''Return x, y of the valid pixels of a n x n mask with a central disk and
+    a few masked holes, similar to a MUSE field with cut out point sources.'''
+
+    rs = numpy.random.RandomState(seed)
+    yy, xx = numpy.mgrid[0:n, 0:n]
+    valid = (xx - n/2.)**2 + (yy - n/2.)**2 < (0.48*n)**2
+    for i in range(10):
+        x0, y0 = rs.randint(0, n, 2)
+        valid[y0:y0 + n//20, x0:x0 + n//20] = False
+
+    y, x = numpy.nonzero(valid)
+    return x, y
+
+
+def synthetic_field(n, seed=1):
+    '''Return x, y, signal, noise of a n x n field with an exponential disk on
+    a faint background, Poisson-like noise and a masked rectangle.'''
+
+    rs = numpy.random.RandomState(seed)
+    yy, xx = numpy.mgrid[0:n, 0:n]
+    r = numpy.hypot(xx - n*0.45, yy - n*0.55)
+    signal = 200.*numpy.exp(-r/(n*0.12)) + 2.
+    noise = numpy.sqrt(signal + 25.)
+    signal = signal + rs.normal(0, 1, signal.shape)*noise*0.3
+    signal[r > n*0.48] = 0
+    signal[int(n*.1):int(n*.2), int(n*.6):int(n*.7)] = 0
+
+    y, x = numpy.nonzero(signal)
+    return x, y, signal[y, x], noise[y, x]
+
+
+def run_binning(x, y, signal, noise, targetSN, **kwargs):
+    '''Run wvt_binning quietly and return the number of bins, WVT iterations
+    (read back from a checkpoint), the wall time and the S/N of the bins.'''
+
+    fd, checkpoint = tempfile.mkstemp(suffix='.npz')
+    os.close(fd)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t0 = time.time()
+        result = muse_voronoi_bin.wvt_binning(x, y, signal, noise.copy(), targetSN, [], 1., [],
+                                              False, 300, 0, True, False, 0.8*targetSN, 360,
+                                              save_all=checkpoint, save_every=100000,
+                                              **kwargs)
+        dt = time.time() - t0
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    iterations = muse_voronoi_bin.wvt_load_checkpoint(checkpoint)[4]
+    os.remove(checkpoint)
+    return len(result[1]), iterations, dt, result[7]
+
+
+def bench_coarse(signalfile=None, noisefile=None, factors=(1, 2, 4), refine_iters=(10, 0),
+                 targetSN=20.):
+    '''Compare the cold binning with the coarse-to-fine start (coarse = 2, 4),
+    with and without the cap refine_iter of the refinement, on synthetic
+    fields and, if given, on a real signal and noise image.'''
+
+    fields = [('synthetic %ix%i' % (n, n), synthetic_field(n)) for n in (150, 300)]
+    if signalfile is not None:
+        fields.append((os.path.basename(signalfile),
+                       muse_voronoi_bin.read_binning_input(signalfile, noisefile)[:4]))
+
+    print('wvt_binning coarse-to-fine start, target S/N = %g' % targetSN)
+    print('%-20s %8s %7s %7s %7s %11s %10s %9s' % ('field', 'npix', 'coarse', 'refine',
+                                                   'bins', 'iterations', 'time [s]',
+                                                   'S/N rms'))
+    for name, (x, y, signal, noise) in fields:
+        for factor in factors:
+            for refine_iter in (refine_iters if factor > 1 else (0,)):
+                nbins, iterations, dt, binSN = run_binning(x, y, signal, noise, targetSN,
+                                                           coarse=factor,
+                                                           refine_iter=refine_iter)
+                print('%-20s %8i %7i %7i %7i %11i %10.2f %9.3f' % (
+                    name, len(x), factor, refine_iter, nbins, iterations, dt,
+                    numpy.std(binSN/targetSN - 1.)))
+
+
+def run_quadtree(x, y, signal, noise, targetSN):
+    '''Run quadtree_binning quietly and return the bin S/N and the wall
+    time.'''
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t0 = time.time()
+        result = muse_voronoi_bin.quadtree_binning(x, y, signal, noise.copy(), targetSN,
+                                                   0.8*targetSN, 360)
+        dt = time.time() - t0
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return result[7], dt
+
+
+def bench_quadtree(sizes=(64, 70, 100, 150), targets=(10., 20.)):
+    '''Compare the bins of quadtree_binning with wvt_binning on synthetic
+    n x n fields, most of them not a power of two on a side: number of bins,
+    relative mean, minimum, maximum and scatter of the bin S/N about the
+    target and the wall time.'''
+
+    print('quadtree_binning against wvt_binning')
+    print('%-8s %6s %-9s %6s %6s %6s %6s %7s %9s' % ('size', 'S/N', 'mode', 'bins', 'mean',
+                                                     'min', 'max', 'rms', 'time [s]'))
+    for n in sizes:
+        x, y, signal, noise = synthetic_field(n)
+        for targetSN in targets:
+            for mode in ('quadtree', 'wvt'):
+                if mode == 'quadtree':
+                    binSN, dt = run_quadtree(x, y, signal, noise, targetSN)
+                else:
+                    nbins, iterations, dt, binSN = run_binning(x, y, signal, noise, targetSN)
+                ratio = binSN/targetSN
+                print('%-8s %6g %-9s %6i %6.2f %6.2f %6.2f %7.3f %9.3f' % (
+                    '%ix%i' % (n, n), targetSN, mode, len(binSN), numpy.mean(ratio),
+                    numpy.min(ratio), numpy.max(ratio), numpy.std(ratio - 1.), dt))
+
+
+def bin_cube_loop(x, y, binNr, data, error):
+    '''The former extraction of voronoi_bins.bin_cube, which adds the spectra
+    of the spaxels of each bin one by one (reference for bench_bin_cube).'''
+
+    nbins = numpy.max(binNr)
+    rss_data = numpy.zeros((nbins, data.shape[0]), dtype=numpy.float32)
+    rss_error = numpy.zeros((nbins, data.shape[0]), dtype=numpy.float32)
+    for l in range(nbins):
+        select_bin = binNr == (l + 1)
+        x_bin = x[select_bin]
+        y_bin = y[select_bin]
+        for j in range(len(x_bin)):
+            rss_data[l, :] += data[:, y_bin[j], x_bin[j]]
+            rss_error[l, :] += error[:, y_bin[j], x_bin[j]]**2
+        rss_error[l, :] = numpy.sqrt(rss_error[l, :])
+    return rss_data, rss_error
+
+
+def bench_bin_cube(nwave=(500, 1500), n=300, block=4):
+    '''Time the spectra extraction of bin_cube (sparse operator) against the
+    former loop over bins and spaxels on a n x n cube binned in blocks.'''
+
+    print('voronoi_bins.bin_spectra vs. loop over bins and spaxels')
+    print('%8s %8s %7s %10s %10s %9s %10s' % ('nwave', 'spaxels', 'bins', 'loop [s]',
+                                              'sparse [s]', 'speed-up', 'max diff'))
+    rs = numpy.random.RandomState(1)
+    y, x = numpy.mgrid[0:n, 0:n]
+    x = x.ravel()
+    y = y.ravel()
+    binNr = (y//block)*((n + block - 1)//block) + x//block + 1
+    for nw in nwave:
+        data = rs.normal(10., 1., (nw, n, n)).astype(numpy.float32)
+        var = rs.uniform(0.5, 1.5, (nw, n, n)).astype(numpy.float32)
+
+        t0 = time.time()
+        loop_data, loop_error = bin_cube_loop(x, y, binNr, data, numpy.sqrt(var))
+        t_loop = time.time() - t0
+
+        t0 = time.time()
+        operator = voronoi_bins.bin_operator(x, y, binNr, data.shape[1:])
+        rss_data, rss_var = voronoi_bins.bin_spectra(operator, data, var)
+        rss_error = numpy.sqrt(rss_var)
+        t_sparse = time.time() - t0
+
+        diff = max(numpy.max(numpy.abs(rss_data - loop_data)/numpy.abs(loop_data)),
+                   numpy.max(numpy.abs(rss_error - loop_error)/loop_error))
+        print('%8i %8i %7i %10.2f %10.2f %9.1f %10.1e' % (nw, n*n, numpy.max(binNr), t_loop,
+                                                          t_sparse, t_loop/t_sparse, diff))
+
+
+def synthetic_cube_file(filename, nwave, n, slab=100, seed=1):
+    '''Write a n x n x nwave cube with data and STAT extensions to filename
+    slab by slab, without holding it in memory, and return the filename.'''
+
+    rs = numpy.random.RandomState(seed)
+    header = fits.PrimaryHDU(numpy.zeros((1, 1, 1), dtype=numpy.float32)).header
+    header['NAXIS1'] = header['NAXIS2'] = n
+    header['NAXIS3'] = nwave
+    header['CRVAL3'] = 4750.
+    stat = fits.ImageHDU(numpy.zeros((1, 1, 1), dtype=numpy.float32), name='STAT').header
+    stat['NAXIS1'] = stat['NAXIS2'] = n
+    stat['NAXIS3'] = nwave
+    with open(filename, 'wb') as f:
+        for hdr, mean in ((header, 10.), (stat, 1.)):
+            f.write(hdr.tostring().encode('ascii'))
+            for start, stop in muse_slab_pipeline.slab_ranges(0, nwave, slab):
+                data = rs.normal(mean, 0.1*mean, (stop - start, n, n)).astype('>f4')
+                data[:, :n//20, :n//20] = numpy.nan
+                f.write(data.tostring())
+            f.write(b'\0'*(-f.tell() % 2880))
+    return filename
+
+
+def _slab_moments_loop(hdu, nwave, slab):
+    '''Band mean and std without the pipeline: read and reduce each slab in
+    turn (reference for bench_slab_pipeline).'''
+
+    read = muse_slab_pipeline.section_reader(hdu)
+    total = None
+    for start, stop in muse_slab_pipeline.slab_ranges(0, nwave, slab):
+        partial = muse_slab_pipeline.slab_moments(start, stop, read(start, stop))
+        total = partial if total is None else muse_slab_pipeline.merge_moments(total, partial)
+    return total
+
+
+def bench_slab_pipeline(nwave=3700, n=300, slabs=(32, 128), workers=(1, 2, 4)):
+    '''Time the full-cube mean/std and bin_cube on a synthetic n x n x nwave
+    cube, read serially slab by slab and through the slab pipeline with
+    different slab sizes and numbers of worker threads.'''
+
+    nwave = int(nwave)
+    n = int(n)
+    tmpdir = tempfile.mkdtemp()
+    cube = synthetic_cube_file(os.path.join(tmpdir, 'cube.fits'), nwave, n)
+    pixels = os.path.join(tmpdir, 'pixel.dat')
+    rss = os.path.join(tmpdir, 'rss.fits')
+    y, x = numpy.mgrid[0:n, 0:n]
+    numpy.savetxt(pixels, numpy.transpose([x.ravel(), y.ravel(),
+                                           (y//4*((n + 3)//4) + x//4 + 1).ravel()]), fmt='%i')
+
+    print('slab pipeline, %ix%ix%i cube (%.1f GB), %i cpus' % (
+        n, n, nwave, os.path.getsize(cube)/1e9, muse_slab_pipeline.cpu_count()))
+    print('%-10s %6s %8s %10s %10s' % ('task', 'slab', 'workers', 'time [s]', 'max diff'))
+    hdulist = fits.open(cube, memmap=False)
+    try:
+        for slab in slabs:
+            t0 = time.time()
+            count, mean, m2 = _slab_moments_loop(hdulist[0], nwave, slab)
+            print('%-10s %6i %8s %10.2f' % ('mean/std', slab, 'serial', time.time() - t0))
+            for nworkers in workers:
+                t0 = time.time()
+                mean_img, std_img = muse_slab_pipeline.band_mean_std(
+                    muse_slab_pipeline.section_reader(hdulist[0]), 0, nwave, slab, nworkers)
+                dt = time.time() - t0
+                diff = max(numpy.max(numpy.abs(mean_img - mean)),
+                           numpy.max(numpy.abs(std_img - numpy.sqrt(m2/count))))
+                print('%-10s %6i %8i %10.2f %10.1e' % ('mean/std', slab, nworkers, dt, diff))
+        for slab in slabs:
+            for nworkers in workers:
+                t0 = time.time()
+                voronoi_bins.bin_cube(pixels, cube, rss, slab=slab, nworkers=nworkers)
+                print('%-10s %6i %8i %10.2f' % ('bin_cube', slab, nworkers, time.time() - t0))
+    finally:
+        hdulist.close()
+        for filename in (cube, pixels, rss):
+            if os.path.exists(filename):
+                os.remove(filename)
+        os.rmdir(tmpdir)
+
+
+def drop_page_cache():
+    '''Try to drop the page cache of the whole system (needs root on Linux),
+    so that the following reads come from disk. Returns whether it worked.
+    Only called on request (bench_spaxel_store with drop_caches=True).'''
+
+    try:
+        os.system('sync')
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('1\n')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def bench_spaxel_store(nwave=3700, n=300, nspec=200, drop_caches=False):
+    '''Time the conversion of a synthetic n x n x nwave cube to a spaxel-major
+    store and the access to nspec random spectra in the FITS cube (memory
+    mapped and through sections) and in the store. The first access of each
+    is cold only with drop_caches=True, which drops the page cache of the
+    system if possible (see drop_page_cache), otherwise it is warm.'''
+
+    nwave = int(nwave)
+    n = int(n)
+    tmpdir = tempfile.mkdtemp()
+    cube = synthetic_cube_file(os.path.join(tmpdir, 'cube.fits'), nwave, n)
+    store = os.path.join(tmpdir, 'store')
+    rs = numpy.random.RandomState(2)
+    x, y = rs.randint(0, n, (2, nspec))
+
+    print('spaxel-major store, %ix%ix%i cube (%.1f GB)' % (n, n, nwave, os.path.getsize(cube)/1e9))
+    try:
+        t0 = time.time()
+        muse_spaxel_store.convert_cube(cube, store)
+        print('conversion: %.2f s' % (time.time() - t0))
+        print('%-16s %16s %10s %6s' % ('access', 'per spectrum [s]', 'max diff', 'cache'))
+
+        hdulist = fits.open(cube, memmap=True)
+        cache = 'cold' if drop_caches and drop_page_cache() else 'warm'
+        t0 = time.time()
+        reference = [numpy.array(hdulist[0].data[:, j, i]) for i, j in zip(x, y)]
+        print('%-16s %16.2e %10s %6s' % ('FITS memmap', (time.time() - t0)/nspec, '', cache))
+        hdulist.close()
+
+        hdulist = fits.open(cube, memmap=False)
+        cache = 'cold' if drop_caches and drop_page_cache() else 'warm'
+        t0 = time.time()
+        for i, j in zip(x[:10], y[:10]):
+            hdulist[0].section[:, j, i]
+        print('%-16s %16.2e %10s %6s' % ('FITS section', (time.time() - t0)/10, '', cache))
+        hdulist.close()
+
+        spaxels = muse_spaxel_store.open_store(store)
+        cache = 'cold' if drop_caches and drop_page_cache() else 'warm'
+        t0 = time.time()
+        found = [numpy.array(muse_spaxel_store.spectrum(spaxels, i, j)[0]) for i, j in zip(x, y)]
+        dt = time.time() - t0
+        diff = max(numpy.nanmax(numpy.abs(a - b)) for a, b in zip(found, reference))
+        print('%-16s %16.2e %10.1e %6s' % ('store', dt/nspec, diff, cache))
+        t0 = time.time()
+        for i, j in zip(x, y):
+            numpy.array(muse_spaxel_store.spectrum(spaxels, i, j)[0])
+        print('%-16s %16.2e %10s %6s' % ('store', (time.time() - t0)/nspec, '', 'warm'))
+        del spaxels
+    finally:
+        for filename in os.listdir(store):
+            os.remove(os.path.join(store, filename))
+        os.rmdir(store)
+        os.remove(cube)
+        os.rmdir(tmpdir)
+
+
+def bench_neighborlist(sizes=(100, 250, 500, 1000)):
+    '''Time wvt_make_neighborlist on n x n masks up to 1000 x 1000.'''
+
+    print('wvt_make_neighborlist')
+    print('%8s %10s %10s %12s %8s' % ('size', 'npix', 'time [s]', 'ns / pixel', 'dtype'))
+    for n in sizes:
+        x, y = circular_mask(n)
+        t0 = time.time()
+        neighborlist = muse_voronoi_bin.wvt_make_neighborlist(x, y)
+        dt = time.time() - t0
+        print('%8s %10i %10.4f %12.1f %8s' % ('%ix%i' % (n, n), len(x), dt,
+                                              dt/len(x)*1e9, neighborlist.dtype))
+
+
+benchmarks = {'bin_cube': bench_bin_cube,
+              'coarse': bench_coarse,
+              'neighborlist': bench_neighborlist,
+              'quadtree': bench_quadtree,
+              'slab_pipeline': bench_slab_pipeline,
+              'spaxel_store': bench_spaxel_store}
+
+
+def main():
+
+    calls = []
+    for arg in sys.argv[1:]:
+        if arg in benchmarks:
+            calls.append((arg, [], {}))
+        elif calls and arg.startswith('--'):
+            calls[-1][2][arg[2:].replace('-', '_')] = True
+        elif calls:
+            calls[-1][1].append(arg)
+    if not calls:
+        calls = [(name, [], {}) for name in sorted(benchmarks)]
+
+    for name, args, options in calls:
+        benchmarks[name](*args, **options)
+        print()
+
+
+if __name__ == '__main__':
+    main()
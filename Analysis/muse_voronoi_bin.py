@@ -35,6 +35,7 @@
 #       -   bin_noise                                                          #
 #       -   wvt_assign_to_bin                                                  #
 #        -  wvt_assign_to_bin_scale                                            #
+#       -   wvt_assign_all_to_bins                                             #
 #                                                                              #
 #   2.  computing of different centroids and roundness values                  #
 #       -   wvt_unweighted_centroid                                            #
@@ -48,38 +49,64 @@
 #       -   wvt_make_neighborlist                                              #
 #       -   wvt_find_neighbors                                                 #
 #       -   wvt_assign_neighbors                                               #
-#       -   wvt_find_binneighbors       (not used)                             #
-#       -   wvt_recursive_neighbors     (not used)                             #
+#       -   wvt_find_binneighbors                                              #
+#       -   wvt_recursive_neighbors                                            #
+#       -   wvt_bin_adjacency                                                  #
+#       -   wvt_update_bin_adjacency                                           #
 #                                                                              #
 #   4.  routines for checking and error prevention                             #
+#       -   NoBinError                                                         #
 #       -   wvt_renumber_binclass                                              #
 #       -   wvt_check_all_bin                                                  #
 #       -   wvt_check_binislands                                               #
 #                                                                              #
 #   5.  routines for the calculation of the binning properties                 #
+#       -   wvt_bin_quantities                                                 #
 #       -   wvt_calc_bin_sn                                                    #
 #       -   compute_bin_quantities                                             #
+#       -   wvt_binning_statistics                                             #
+#       -   wvt_match_pixels                                                   #
+#       -   wvt_compare_binclass                                               #
+#       -   wvt_binclass_image                                                 #
 #       -   show_binclass                                                      #
+#       -   wvt_live_plot                                                      #
 #                                                                              #
 #   6.  basic routines for accretion, reassigning and equalizing of the bins   #
 #       -   wvt_bin_accretion                                                  #
 #       -   wvt_reassign_bad_bins                                              #
+#       -   wvt_warm_start_binclass                                            #
+#       -   wvt_coarse_pixels                                                  #
 #       -   wvt_equal_mass                                                     #
 #                                                                              #
 #   7.  routines for reading input and writing outputs                         #
 #       -   read_fits                                                          #
+#       -   read_binning_input                                                 #
+#       -   wvt_save_checkpoint                                                #
+#       -   wvt_load_checkpoint                                                #
+#       -   read_binning_generators                                            #
+#       -   read_binning_pixels                                                #
+#       -   wvt_telemetry_phase                                                #
+#       -   wvt_telemetry_report                                               #
 #       -   write_fits                                                         #
+#       -   write_binning_fits                                                 #
 #       -   write_binning_results                                              #
 #                                                                              #
 #   8.  main program routines                                                  #
 #       -   wvt_binning                                                        #
+#       -   wvt_binning_components                                             #
+#       -   quadtree_binning                                                   #
 #       -   binning_fits                                                       #
+#       -   binning_ladder                                                     #
+#       -   binning_tiled                                                      #
+#       -   read_batch_manifest                                                #
+#       -   binning_batch                                                      #
 #                                                                              #
 ################################################################################
 
 
-import numpy, os, pylab, sys
+import ast, json, multiprocessing, numpy, os, pylab, Queue, sys, threading, time, traceback
 from astropy.io import fits as pyfits
+from scipy import ndimage, sparse, spatial
 
 
 ################################################################################
@@ -113,6 +140,76 @@ def wvt_assign_to_bin_scale(x, y, xnode, ynode, scale):
 # i.e. this constructs the weighted voronoi tesselation
     return numpy.argmin(((x-xnode)/scale)**2 + ((y-ynode)/scale)**2)
 
+def wvt_assign_all_to_bins(x, y, xnode, ynode, nodeSN, nneighbors=8):
+# Assigns all pixels to the S/N weighted closest node at once. The result is
+# identical to calling wvt_assign_to_bin for each single pixel (including the
+# choice of the lowest node number for equal distances).
+# The nodes are grouped by their weight (factors of two), and for every group
+# a KD-tree returns the nneighbors closest nodes as candidates. A node outside
+# of the candidates can only win if its weighted distance, bounded from below
+# by the distance of the last candidate times the smallest weight of the
+# group, is not larger than the best candidate. Only these few pixels are
+# compared with all nodes.
+
+    npix  = len(x)
+    nbins = len(xnode)
+    nodeSN = numpy.zeros(nbins, dtype=numpy.float) + nodeSN
+    binclass = numpy.zeros(npix, dtype=numpy.int)
+    if npix == 0: return binclass
+
+    x = numpy.asarray(x)
+    y = numpy.asarray(y)
+    unresolved = numpy.arange(npix)
+
+    if numpy.all(numpy.isfinite(nodeSN)) and numpy.min(nodeSN) > 0:
+        # group the nodes by their weight (at most 16 groups)
+        level = numpy.floor(numpy.log2(nodeSN/numpy.min(nodeSN))).astype(numpy.int)
+        level //= max(1, (numpy.max(level)+16)//16)
+        groups = []
+        for l in numpy.unique(level):
+            ind  = numpy.where(level == l)[0]
+            tree = spatial.cKDTree(numpy.column_stack((xnode[ind], ynode[ind])))
+            groups.append((ind, tree, numpy.min(nodeSN[ind]), min(nneighbors, len(ind))))
+
+        unresolved = []
+        chunk = 65536
+        for start in range(0, npix, chunk):
+            xc  = x[start:start+chunk]
+            yc  = y[start:start+chunk]
+            pos = numpy.column_stack((xc, yc)).astype(numpy.float)
+
+            candidates = []
+            bound = numpy.zeros(len(xc), dtype=numpy.float) + numpy.inf
+            for ind, tree, minSN, k in groups:
+                dist, j = tree.query(pos, k)
+                if k == 1:
+                    dist = dist[:,None]
+                    j    = j[:,None]
+                candidates.append(ind[j])
+                if k < len(ind):
+                    bound = numpy.minimum(bound, dist[:,-1]**2*minSN)
+            candidates = numpy.hstack(candidates)
+
+            # same arithmetic as in wvt_assign_to_bin
+            wdist = ((xc[:,None]-xnode[candidates])**2 +
+                     (yc[:,None]-ynode[candidates])**2)*nodeSN[candidates]
+            best  = numpy.min(wdist, axis=1)
+            binclass[start:start+chunk] = numpy.min(
+                numpy.where(wdist == best[:,None], candidates, nbins), axis=1)
+
+            # pixels where a node outside of the candidates might be closer
+            unresolved.append(start + numpy.where(best >= bound*(1.-1e-10))[0])
+        unresolved = numpy.concatenate(unresolved)
+
+    # brute force for the remaining pixels
+    chunk = max(1, 4000000//nbins)
+    for start in range(0, len(unresolved), chunk):
+        ind = unresolved[start:start+chunk]
+        binclass[ind] = numpy.argmin(((x[ind,None]-xnode)**2 +
+                                      (y[ind,None]-ynode)**2)*nodeSN, axis=1)
+
+    return binclass
+
 ################################################################################
 #                                                                              #
 #   2.  computing of different centroids and roundness values                  #
@@ -237,30 +334,35 @@ def match_int(a, b):
 
 def wvt_make_neighborlist(x, y):
 # Create a list of neighbors for each pixel
+# Every pixel is mapped directly onto an index grid of the sorted unique x and
+# y values, so the list is built in linear time without searching. Each row
+# contains the four direct neighbors in ascending order, -1 if not defined.
 
     npix = len(x)
-    neighborlist = numpy.zeros((npix,4), dtype=numpy.int)
+    # compact integer type for the pixel indices
+    if npix < 2**31 - 1: itype = numpy.int32
+    else:                itype = numpy.int64
 
-    # Find sorted unique values of x and y
-    uniquey  = numpy.unique(y)
-    uniquex  = numpy.unique(x)
+    # Position of each pixel in the sorted unique values of x and y
+    uniquex, ix = numpy.unique(x, return_inverse=True)
+    uniquey, iy = numpy.unique(y, return_inverse=True)
+    ix = ix.astype(itype) + 1
+    iy = iy.astype(itype) + 1
 
     # make a square which contains the pixel numbers [[0, 1, 2,... ,npix]]
     # and an outer edge of the width of one pixel
     # non-defined pixels and outer edge pixel are set to -1
-    mask = numpy.zeros((len(uniquex)+2,len(uniquey)+2), dtype=numpy.int)-1
-    for i in range(npix):
-        ix = numpy.where(uniquex == x[i])[0]
-        iy = numpy.where(uniquey == y[i])[0]
-        mask[ix+1,iy+1] = i
-
-    # each pixel gets assigned to the reversed sorted neighbourlist
-    for i in range(len(uniquex)):
-        for j in range(len(uniquey)):
-            pix = mask[i,j]
-            if pix >= 0:
-                neighborlist[pix,:] = numpy.sort([mask[i-1,j], mask[i,j+1],
-                                                  mask[i+1,j], mask[i,j-1]])  
+    mask = numpy.empty((len(uniquex)+2,len(uniquey)+2), dtype=itype)
+    mask.fill(-1)
+    mask[ix, iy] = numpy.arange(npix, dtype=itype)
+
+    # each pixel gets assigned to the sorted neighbourlist
+    neighborlist = numpy.empty((npix,4), dtype=itype)
+    neighborlist[:,0] = mask[ix-1, iy]
+    neighborlist[:,1] = mask[ix, iy+1]
+    neighborlist[:,2] = mask[ix+1, iy]
+    neighborlist[:,3] = mask[ix, iy-1]
+    neighborlist.sort(axis=1)
 
     return neighborlist
 
@@ -320,16 +422,24 @@ def wvt_assign_neighbors(neighborlist, binclass):
 
 def wvt_find_binneighbors(neighborlist, neighborbinclass, binclass, area):
 ## Produces the final list of *unique* bin neighbors.
+# Every bin with area > 0 gets the array of its neighbor bins. All pairs of
+# bins are collected in one pass over the pixels.
 
     #if len(area) == 0:
         #area = numpy.histogram(binclass, range(0, nbins+1), new=True)[0]
     good = numpy.where(area > 0)[0]    # Check for zero-size Voronoi bins
 
+    # unique pairs (bin of pixel, bin of neighbor), sorted by the first bin
+    nbins = max(len(area), numpy.max(binclass)+1)
+    pairs = binclass[:,None]*nbins + neighborbinclass
+    pairs = numpy.unique(pairs[neighborbinclass > -1])
+    first = pairs//nbins
+    start = numpy.searchsorted(first, good)
+    end   = numpy.searchsorted(first, good, side='right')
+
     binneighbors = {}
-    for i in good:
-        ind = numpy.where(binclass == i)[0]
-        tmplist = numpy.unique(neighborbinclass[ind])
-        binneighbors[i] = tmplist[numpy.where(tmplist > -1)]
+    for i in range(len(good)):
+        binneighbors[good[i]] = pairs[start[i]:end[i]] % nbins
 
     return binneighbors
 
@@ -338,20 +448,82 @@ def wvt_recursive_neighbors(binneighbors, current, nlevels):
 # iteration. Takes the list of bin neighbors for each single bin and
 # recursively finds the next closest neighbors by stepping down "nlevels"
 # in the hierarchy. "Current" is the list of bins you would find neighbors for.
+# binneighbors can also be the bin adjacency matrix from wvt_bin_adjacency.
 
+    empty = numpy.zeros(0, dtype=numpy.int)
     for i in range(nlevels+1):
-        tmplist = numpy.copy(current)
-        for j in current:
-            tmplist = numpy.append(tmplist, binneighbors[j])
-        current = numpy.unique(tmplist)
+        if sparse.issparse(binneighbors):
+            tmplist = [numpy.asarray(current), binneighbors[current].indices]
+        else:
+            tmplist = [numpy.asarray(current)] + [binneighbors.get(j, empty) for j in current]
+        current = numpy.unique(numpy.concatenate(tmplist))
 
     return current
 
+def wvt_bin_adjacency(neighborlist, binclass, nbins):
+# Builds the bin adjacency graph in one pass over the pixel neighbor list:
+# a sparse nbins x nbins matrix, where entry (i, j) is the number of pixel
+# pairs of bin i and bin j that are direct neighbors (i != j). The neighbor
+# bins of bin i are adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i+1]]
+
+    neighborbinclass = wvt_assign_neighbors(neighborlist, binclass)
+    first = numpy.repeat(binclass, neighborlist.shape[1])
+    second = neighborbinclass.ravel()
+    ind = numpy.where(numpy.logical_and(second > -1, first != second))[0]
+
+    adjacency = sparse.csr_matrix((numpy.ones(len(ind), dtype=numpy.int32),
+                                   (first[ind], second[ind])), shape=(nbins, nbins))
+    adjacency.sum_duplicates()
+
+    return adjacency
+
+def wvt_update_bin_adjacency(adjacency, neighborlist, binclassold, binclass, changed):
+# Updates the bin adjacency graph of wvt_bin_adjacency after the pixels in
+# "changed" moved from binclassold to binclass. Only the pixel pairs that
+# contain a changed pixel are counted again.
+
+    if len(changed) == 0: return adjacency
+
+    # all pairs of neighboring pixels with at least one changed pixel, once each
+    first  = numpy.repeat(changed, neighborlist.shape[1])
+    second = neighborlist[changed].ravel()
+    ind    = numpy.where(second > -1)[0]
+    npix   = len(binclass)
+    pairs  = numpy.unique(numpy.minimum(first[ind], second[ind])*npix +
+                          numpy.maximum(first[ind], second[ind]))
+    first  = pairs//npix
+    second = pairs % npix
+
+    # remove the old and add the new links (in both directions)
+    rows   = []
+    cols   = []
+    counts = []
+    for bins, weight in ((binclassold, -1), (binclass, 1)):
+        a = bins[first]
+        b = bins[second]
+        ind = numpy.where(a != b)[0]
+        rows   += [a[ind], b[ind]]
+        cols   += [b[ind], a[ind]]
+        counts += [numpy.zeros(2*len(ind), dtype=numpy.int32) + weight]
+    delta = sparse.csr_matrix((numpy.concatenate(counts),
+                               (numpy.concatenate(rows), numpy.concatenate(cols))),
+                              shape=adjacency.shape)
+
+    adjacency = adjacency + delta
+    adjacency.eliminate_zeros()
+
+    return adjacency
+
 ################################################################################
 #                                                                              #
 #   4.  routines for checking and error prevention                             #
 #                                                                              #
 ################################################################################
+class NoBinError(ValueError):
+# raised by wvt_binning if the bin accretion finds no bin that reaches the S/N
+# limit, so that there is no good bin to reassign the other pixels to
+    pass
+
 def wvt_renumber_binclass(binclass, start_binclass=0, area=[]):
 # Kicks out zero pixel bins and renumbers the rest continuously starting at
 # the value start_binclass
@@ -367,91 +539,150 @@ def wvt_renumber_binclass(binclass, start_binclass=0, area=[]):
 
     return binclass
 
-def wvt_check_all_bins(binclass, x, y, xnode, ynode):
+def wvt_check_all_bins(binclass, x, y, xnode, ynode, pixeltree=None):
 # Sanity checks: make sure you don't have coinciding bin centers (possible
 # in WVTs, IF one bin is completely enclosed by another bin of larger scale
 # length. In cases with holes in the data, it is generally possible to have
 # the bin center outside the valid data and the bin containing zero pixels.
+# Such a bin gets the closest pixel of a bin with more than one pixel, which
+# is searched in a KD-tree of the pixels (pixeltree, built if not given).
 
-    area = numpy.histogram(binclass, range(0, max(binclass)+2))[0]
+    nbins = max(len(xnode), numpy.max(binclass)+1)
+    area = numpy.bincount(binclass, minlength=nbins)
     bad = numpy.where(area == 0)[0]    # Check for zero-size Voronoi bins
 
     while len(bad) > 0:
+        if pixeltree is None:
+            pixeltree = spatial.cKDTree(numpy.column_stack((x, y)))
         # You have to make sure that you don't assign the center of another 1 pixel bin
-        good2 = numpy.where(area > 1)[0]
+        good2 = area > 1
         for n in bad:
-            tmp = numpy.argsort((x-xnode[n])**2+(y-ynode[n])**2)
-            loop = 0
+            k = 16
             while True:
-                if numpy.sum(numpy.where(good2 == binclass[tmp[loop]])[0]) > 0:
-                    ind = tmp[loop]
-                    break
-                loop += 1
+                k = min(k, len(x))
+                tmp = pixeltree.query([xnode[n], ynode[n]], k)[1]
+                tmp = numpy.atleast_1d(tmp)
+                w = numpy.where(good2[binclass[tmp]])[0]
+                if (len(w) > 0) or (k == len(x)): break
+                k *= 4
+            if len(w) == 0: continue
+            ind = tmp[w[0]]
             # Set the centroid to the center of the pixel
             binclass[ind] = n
             xnode[n] = x[ind]
             ynode[n] = y[ind]
             print 'Bin with zero pixels found: ', n
-        if len(bad) != 0:
-            area = numpy.histogram(binclass, range(0, max(binclass)+2))[0]
+        area_new = numpy.bincount(binclass, minlength=nbins)
+        if numpy.all(area_new == area): break     # nothing could be repaired
+        area = area_new
         bad = numpy.where(area == 0)[0]
 
     return binclass, area
 
-def wvt_check_binislands(x, y, binclass, neighborbinclass, xnode, ynode):
+def wvt_check_binislands(x, y, binclass, neighborlist, xnode, ynode, adjacency):
 # Checks that every bin is not enclosed by another bin, i.e. has more than
 # one neighboring bin. Note that this check should be avoided if you have
 # lots of gaps in your data since then you could have an isolated bin due
 # to the fact that the gaps are "cornering" the bin.
+# The enclosed bins are the rows of the bin adjacency graph (see
+# wvt_bin_adjacency) with exactly one entry. The graph is kept up to date
+# and returned.
 
     nbins = len(xnode)
-    area = numpy.histogram(binclass, range(0, max(binclass)+2))[0]
-    bad = numpy.where(area == 0)[0]    # Check for zero-size Voronoi bins
-
-    recalc_area = False
-    for k in range(nbins):
-        ind = numpy.where(binclass == k)[0]    # Find subscripts of pixels in bin k.
-        neighbornodes = numpy.unique(neighborbinclass[ind])
-        w1 = numpy.logical_not(neighbornodes == -1)
-        w2 = numpy.logical_not(neighbornodes == k)
-        w = numpy.logical_and(w1, w2)
-        if numpy.sum(w) >  0: neighbornodes = neighbornodes[w]
-        if numpy.sum(w) == 1:
-            k2 = neighbornodes[0]
-            print 'Bin', k, 'is enclosed by bin', k2, '| Redistributing bins.'
-            ind = numpy.append(ind, numpy.where(binclass == k2)[0]) # add the other bin pixels
-            tmp = numpy.array([k, k2], dtype=numpy.int)   # only search among 2 nodes
-            for i in ind:
-                j = wvt_assign_to_bin(x[i], y[i], xnode[tmp], ynode[tmp], 1.)
-                binclass[i] = tmp[j]
-            recalc_area = True
-
-    if recalc_area == True:
-        area = numpy.histogram(binclass, range(0, max(binclass)+2))[0]
-    return binclass, area
-
+    enclosed = numpy.where(numpy.diff(adjacency.indptr) == 1)[0]
+
+    if len(enclosed) > 0:
+        # pixels of each bin: order[bounds[k]:bounds[k+1]], or members[k] if
+        # the bin was changed already
+        order   = numpy.argsort(binclass, kind='mergesort')
+        bounds  = numpy.searchsorted(binclass[order], numpy.arange(nbins+1))
+        members = {}
+
+    for k in enclosed:
+        neighbornodes = adjacency.indices[adjacency.indptr[k]:adjacency.indptr[k+1]]
+        if len(neighbornodes) != 1: continue    # changed by an earlier redistribution
+        k2 = neighbornodes[0]
+        print 'Bin', k, 'is enclosed by bin', k2, '| Redistributing bins.'
+        ind = numpy.append(members.get(k,  order[bounds[k]:bounds[k+1]]),
+                           members.get(k2, order[bounds[k2]:bounds[k2+1]]))  # add the other bin pixels
+        tmp = numpy.array([k, k2], dtype=numpy.int)   # only search among 2 nodes
+        binclassold = numpy.copy(binclass)
+        binclass[ind] = tmp[wvt_assign_all_to_bins(x[ind], y[ind], xnode[tmp], ynode[tmp], 1.)]
+        members[k]  = ind[binclass[ind] == k]
+        members[k2] = ind[binclass[ind] == k2]
+        changed = ind[binclass[ind] != binclassold[ind]]
+        adjacency = wvt_update_bin_adjacency(adjacency, neighborlist, binclassold, binclass, changed)
+
+    area = numpy.bincount(binclass, minlength=nbins)
+    return binclass, area, adjacency
 
 ################################################################################
 #                                                                              #
 #   5.  routines for the calculation of the binning properties                 #
 #                                                                              #
 ################################################################################
+def wvt_bin_quantities(binclass, x=None, y=None, signal=None, noise=None,
+                       density=None, nbins=0):
+# Computes the properties of all bins in one pass with weighted bincounts
+# instead of looping over the bins: area, summed signal, noise added in
+# quadrature, S/N, the geometric centroid and the density weighted centroid
+# (the signal is taken if no density is given). Bins with negative mass are
+# treated as in wvt_weighted_centroid. Quantities that need an input which is
+# not given are returned as None.
+
+    if nbins == 0: nbins = numpy.max(binclass)+1
+
+    area = numpy.bincount(binclass, minlength=nbins)[:nbins]
+
+    binsignal = binnoise = binSN = None
+    xbar = ybar = xwbar = ywbar = None
+    if signal is not None:
+        binsignal = numpy.bincount(binclass, signal, minlength=nbins)[:nbins]
+        if density is None: density = signal
+    if noise is not None:
+        binnoise = numpy.sqrt(numpy.bincount(binclass, noise**2, minlength=nbins)[:nbins])
+
+    olderr = numpy.seterr(divide='ignore', invalid='ignore')
+
+    if (signal is not None) and (noise is not None):
+        binSN = binsignal/binnoise
+
+    if x is not None:
+        # geometric centroid
+        xbar = numpy.bincount(binclass, x, minlength=nbins)[:nbins]/area
+        ybar = numpy.bincount(binclass, y, minlength=nbins)[:nbins]/area
+        xwbar = numpy.copy(xbar)
+        ywbar = numpy.copy(ybar)
+
+    if (x is not None) and (density is not None):
+        # weighted centroid, for bins with negative mass use only the positive
+        # pixels, or the geometric centroid if there is no positive pixel
+        positive = numpy.where(density > 0, density, 0.)
+        mass  = numpy.bincount(binclass, density, minlength=nbins)[:nbins]
+        massp = numpy.bincount(binclass, positive, minlength=nbins)[:nbins]
+        npos  = numpy.bincount(binclass, positive > 0, minlength=nbins)[:nbins]
+        xwbar = numpy.bincount(binclass, x*density, minlength=nbins)[:nbins]/mass
+        ywbar = numpy.bincount(binclass, y*density, minlength=nbins)[:nbins]/mass
+        neg = numpy.where(mass <= 0)[0]
+        if len(neg) > 0:
+            xwbar[neg] = numpy.bincount(binclass, x*positive, minlength=nbins)[neg]/massp[neg]
+            ywbar[neg] = numpy.bincount(binclass, y*positive, minlength=nbins)[neg]/massp[neg]
+            nopos = neg[npos[neg] == 0]
+            xwbar[nopos] = xbar[nopos]
+            ywbar[nopos] = ybar[nopos]
+
+    numpy.seterr(**olderr)
+
+    return area, binsignal, binnoise, binSN, xbar, ybar, xwbar, ywbar
+
 def wvt_calc_binSN(binclass, signal, noise):
 # Calculates the S/N values for all bins
-# New version, should be considerably faster for large nbin
 # Note: binnumber has to start at 0 and end at nbins-1!
 
-    nbins = max(binclass)+1
-    binSN = numpy.zeros(nbins, dtype=numpy.float)
+    area, binsignal, binnoise, binSN = wvt_bin_quantities(binclass, signal=signal, noise=noise)[:4]
 
-    #if len(area) == 0:
-    area = numpy.histogram(binclass, range(0, nbins+1))[0]
-    good = numpy.where(area > 0)[0]    # Check for zero-size Voronoi bins
-
-    # Only loop over nonzero bins
-    for i in good:
-        ind = numpy.where(binclass == i)[0]      # Find subscripts of pixels in bin i
-        binSN[i] = add_signal(signal[ind])/add_noise(noise[ind])
+    # zero-size Voronoi bins get S/N = 0
+    binSN[area == 0] = 0.
 
     return binSN, area
 
@@ -459,31 +690,164 @@ def compute_bin_quantities(x, y, signal, noise, binclass):
 # At the end of the computation evaluate the bin luminosity-weighted
 # centroids (xbar,ybar) and the corresponding final S/N of each bin.
 
-    nbins = max(binclass)+1
+    area, binsignal, binnoise, binSN, xgeo, ygeo, xbar, ybar = \
+        wvt_bin_quantities(binclass, x, y, signal, noise)
 
-    xbar      = numpy.zeros(nbins, dtype=numpy.float)
-    ybar      = numpy.zeros(nbins, dtype=numpy.float)
-    binsignal = numpy.zeros(nbins, dtype=numpy.float)
-    binnoise  = numpy.zeros(nbins, dtype=numpy.float)
-    binSN     = numpy.zeros(nbins, dtype=numpy.float)
-    for i in range(nbins):
-        ind = numpy.where(binclass == i)[0]
-        xbar[i], ybar[i] = wvt_weighted_centroid(x[ind], y[ind], signal[ind])
-        binsignal[i]     = bin_signal(signal[ind])
-        binnoise[i]      = bin_noise(noise[ind])
-        binSN[i]         = binsignal[i]/binnoise[i]
+    olderr = numpy.seterr(divide='ignore', invalid='ignore')
+    binsignal = binsignal/area      # as in bin_signal
+    binnoise  = binnoise/area       # as in bin_noise
+    binSN     = binsignal/binnoise
+    numpy.seterr(**olderr)
 
     return xbar, ybar, binsignal, binnoise, binSN
 
+def wvt_binning_statistics(binSN, area, targetSN, valid_SN, valid_area):
+# Returns the number of valid bins (single pixels and bins with S/N >= valid_SN
+# and less than valid_area pixels), the average S/N of the valid bins with more
+# than one pixel and their relative S/N scatter around the target and the
+# average S/N
+
+    w1 = area == 1
+    w2 = area > 1
+    w3 = numpy.logical_and(binSN >= valid_SN, area < valid_area)
+    w4 = numpy.logical_and(w2, w3)
+    averageSN = numpy.mean(binSN[w4])
+    nvalid    = numpy.sum(w4)+numpy.sum(w1)
+    scatter_target  = numpy.std((binSN[w4]-targetSN)/targetSN)
+    scatter_average = numpy.std((binSN[w4]-averageSN)/averageSN)
+
+    return nvalid, averageSN, scatter_target, scatter_average
+
+def wvt_match_pixels(x, y, xold, yold):
+# returns for each pixel (x,y) the index of the same pixel in (xold,yold),
+# or -1 if it is not contained there
+
+    width  = max(numpy.max(x), numpy.max(xold))+1
+    key    = numpy.asarray(y, dtype=numpy.int64)*width+x
+    keyold = numpy.asarray(yold, dtype=numpy.int64)*width+xold
+
+    order = numpy.argsort(keyold, kind='mergesort')
+    pos   = numpy.searchsorted(keyold[order], key)
+    pos[pos == len(keyold)] = 0
+    index = order[pos]
+    index[keyold[index] != key] = -1
+
+    return index
+
+def wvt_compare_binclass(binclass, binclassold, areaold=None):
+# compares two binnings of (mostly) the same pixels. binclassold is the old
+# bin number of each pixel of binclass (-1 for new pixels), areaold the
+# number of pixels of the old bins, if some of their pixels are not contained
+# in binclass. Returns for each new bin the old bin with exactly the same
+# pixels, or -1 if the bin has changed
+
+    nbins  = numpy.max(binclass)+1
+    matched = binclassold >= 0
+    if areaold is None:
+        areaold = numpy.bincount(binclassold[matched])
+    nold = len(areaold)
+
+    # distinct pairs of old and new bins sharing pixels
+    pairs = numpy.unique(binclassold[matched].astype(numpy.int64)*nbins+binclass[matched])
+    pold  = pairs // nbins
+    pnew  = pairs % nbins
+    nold_per_new = numpy.bincount(pnew, minlength=nbins)
+    nnew_per_old = numpy.bincount(pold, minlength=nold)
+
+    partner = numpy.zeros(nbins, dtype=numpy.int)-1
+    partner[pnew] = pold
+    area   = numpy.bincount(binclass, minlength=nbins)
+    shared = numpy.bincount(binclass[matched], minlength=nbins)
+
+    same = (nold_per_new == 1) & (shared == area)
+    same[same] = (nnew_per_old[partner[same]] == 1) & (areaold[partner[same]] == area[same])
+    partner[~same] = -1
+
+    return partner
+
+def wvt_binclass_image(x, y, binclass):
+# returns the map of the bin numbers (0 outside of the pixels)
+
+    binclass_arr = numpy.zeros((numpy.max(y)+1, numpy.max(x)+1), dtype=numpy.float)
+    binclass_arr[y, x] = binclass
+
+    return binclass_arr
+
 def show_binclass(x, y, binclass):
 # plots a map of all bins
 
-    size = (max(y)+1, max(x)+1)
-    binclass_arr = numpy.zeros(size, dtype=numpy.float)
+    pylab.imshow(wvt_binclass_image(x, y, binclass), vmin=0, interpolation='nearest',
+                 origin='lower', cmap=pylab.get_cmap('gist_ncar_r'))
+
+def wvt_live_plot(every=0, seconds=2., snapshot=''):
+# Returns a plot callback for the plot keyword of wvt_binning, which shows the
+# map of the bins while they are made. It is called after every bin of the
+# accretion and every WVT iteration, but only draws every `every` calls
+# (if every > 0) or at most every `seconds` seconds, and the first and last
+# (final=True) time.
+# snapshot = '':     the map is updated in an interactive figure with
+#                    pylab.pause, i.e. without blocking
+# snapshot = prefix: the maps are written to prefix_00001.png, ... by a
+#                    background thread; if it is still busy, a map is skipped
+#                    instead of waiting for it
+
+    state = {'calls': 0, 'last': 0., 'frame': 0, 'image': None, 'thread': None}
+    frames = Queue.Queue(maxsize=1)
+
+    def writer():
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        while True:
+            item = frames.get()
+            if item is None: break
+            frame, image = item
+            fig = Figure()
+            FigureCanvasAgg(fig)
+            fig.add_subplot(111).imshow(image, vmin=0, interpolation='nearest',
+                                        origin='lower', cmap='gist_ncar_r')
+            fig.savefig('%s_%05i.png' %(snapshot, frame))
+
+    def live(x, y, binclass, good=None, final=False):
+        state['calls'] += 1
+        now = time.time()
+        if not final and state['calls'] > 1:
+            if every > 0:
+                if state['calls'] % every != 0: return
+            elif now-state['last'] < seconds: return
+        state['last'] = now
+
+        if good is not None: binclass = binclass*good
+        image = wvt_binclass_image(x, y, binclass)
+
+        if snapshot == '':
+            if state['image'] is None:
+                pylab.ion()
+                pylab.figure()
+                state['image'] = pylab.imshow(image, vmin=0, interpolation='nearest',
+                                              origin='lower', cmap=pylab.get_cmap('gist_ncar_r'))
+            else:
+                state['image'].set_data(image)
+                state['image'].set_clim(0, max(numpy.max(image), 1))
+            pylab.pause(0.001)
+            return
+
+        if state['thread'] is None:
+            state['thread'] = threading.Thread(target=writer)
+            state['thread'].daemon = True
+            state['thread'].start()
+        state['frame'] += 1
+        if final:
+            frames.put((state['frame'], image))
+            frames.put(None)
+            state['thread'].join()
+            state['thread'] = None
+        else:
+            try:
+                frames.put_nowait((state['frame'], image))
+            except Queue.Full:
+                state['frame'] -= 1
 
-    for i in range(len(x)): binclass_arr[y[i], x[i]] = binclass[i]
-    pylab.imshow(binclass_arr, vmin=0, interpolation='nearest', origin='lower',
-                 cmap=pylab.get_cmap('gist_ncar_r'))
+    return live
 
 
 ################################################################################
@@ -492,20 +856,26 @@ def show_binclass(x, y, binclass):
 #                                                                              #
 ################################################################################
 def wvt_bin_accretion(x, y, signal, noise, targetSN, dens,
-                      pixelSize, center, max_area, quiet, plot):
+                      pixelSize, center, max_area, quiet, plot, neighborlist=None):
 # Implementation of the bin accretion algorithm. Optimized for speed when
 # working with large images. Uses a list of neighboring pixels to search
 # only pixels adjacent to the already binned pixels when trying to add
 # the next pixel, instead of searching the whole list.
 # Based on steps (i)-(v) in section 5.1 of Cappellari & Copin (2003),
 # but severely modified
+# Each accretion step costs O(1): the bin is grown in a preallocated buffer,
+# signal, squared noise and centroid are kept as running sums and the maximum
+# distance of the members to the centroid is bracketed by bounds that are
+# updated with the shift of the centroid. The exact (old) expressions are
+# only evaluated if a test is too close to call, so the bins are identical.
 
     npix = len(x)
     print 'PixelSize = ', pixelSize
 
-    # Create neighbor list for each pixel
-    print '...making neighbor list...'
-    neighborlist = wvt_make_neighborlist(x, y)
+    # Create neighbor list for each pixel (unless it is given)
+    if neighborlist is None:
+        print '...making neighbor list...'
+        neighborlist = wvt_make_neighborlist(x, y)
 
     binclass = numpy.zeros(npix, dtype=numpy.int)      # will contain bin numberof pixel
     good     = numpy.zeros(npix, dtype=numpy.int)      # will contain 1 if bin has been accepted as goos
@@ -534,8 +904,22 @@ def wvt_bin_accretion(x, y, signal, noise, targetSN, dens,
     goodold     = 0     # 1 if old bin was marked as good
     totarea     = 0     # total area of all binned pixel
     totgoodbins = 0     # total number of good bins
+    nunbinned   = npix  # number of pixels not yet assigned to a bin
+    # relative precision of the sums (lower for float32 input)
+    eps = max(numpy.finfo(numpy.promote_types(numpy.float32, signal.dtype)).eps,
+              numpy.finfo(numpy.promote_types(numpy.float32, noise.dtype)).eps)
+
+    # All pixels sorted by their distance to the first bin (stable, i.e. the
+    # lower pixel number comes first for equal distances). The next bin
+    # starts at the first pixel in this list that is not binned yet, so the
+    # list is only walked through once.
+    seedorder = numpy.argsort((x-xbar_start)**2 + (y-ybar_start)**2, kind='mergesort')
+    nextseed  = 0
+
+    # buffer for the members of the current bin and the candidate pixel
+    binbuf = numpy.zeros(int(min(max_area, npix))+1, dtype=numpy.int)
 
-    #if (plot == True): pylab.ion()
+    if plot is True: plot = wvt_live_plot()
 
     for ind in range(1,npix+1):     # The first bin will be assigned BIN = 1
 
@@ -543,7 +927,7 @@ def wvt_bin_accretion(x, y, signal, noise, targetSN, dens,
 
         if (quiet == False) and goodold == 1:
             print r'Bin: %3i | S/N: %5.2f | n_pixels: %3i | %5.2f%% done' \
-                   %(totgoodbins, SNold, binareaold, 100.*(1.-float(len(unBinned))/float(npix)))
+                   %(totgoodbins, SNold, binareaold, 100.*(1.-float(nunbinned)/float(npix)))
 
         # .some starting parameters
         binarea    = 1     # actual area of the bin
@@ -552,6 +936,17 @@ def wvt_bin_accretion(x, y, signal, noise, targetSN, dens,
         binclass[currentBin] = ind  # Here currentBin is still made of one pixel
         xbar = x[currentBin]
         ybar = y[currentBin]        # Centroid of one pixel
+        binbuf[0] = currentBin[0]
+
+        # running sums of the bin members
+        sumsignal  = float(signal[currentBin[0]])
+        abssignal  = abs(sumsignal)
+        sumnoise2  = float(noise[currentBin[0]])**2
+        sumx       = float(x[currentBin[0]])
+        sumy       = float(y[currentBin[0]])
+        maxdist_lo = 0.     # lower and upper bound of the maximum distance
+        maxdist_hi = 0.     # of the members to the unweighted centroid
+        SNexact    = True   # SN is the same number as the old expression
 
         while True:
 
@@ -562,26 +957,33 @@ def wvt_bin_accretion(x, y, signal, noise, targetSN, dens,
             # increase the scatter around the target S/N due to "overshooting".
             # Also stop accreting if the bin size reached "max_area"
             modtargetSN = targetSN - SN*(numpy.sqrt(1.+1./binarea)-1.)/2.
+            if (not SNexact) and abs(SN - modtargetSN) <= SNtol:
+                SN = add_signal(signal[binbuf[:binarea]])/add_noise(noise[binbuf[:binarea]])
+                SNexact = True
+                modtargetSN = targetSN - SN*(numpy.sqrt(1.+1./binarea)-1.)/2.
             if (SN >= modtargetSN) or (binarea >= max_area):
-                good[currentBin] = 1
+                good[binbuf[:binarea]] = 1
                 SNold = numpy.copy(SN)
-                binSN[currentBin] = SN
+                binSN[binbuf[:binarea]] = SN
                 break
 
             # Find nearest neighbors of pixels in the current bin, i.e.
             # pixels contiguous with the bin, that have a chance of being accreted
             # For speed, remember the neighbors from the last accretion step and
             # simply add the new ones.
-            neighbors, exneighbors = wvt_find_neighbors(currentBin, neighborlist, neighbors, exneighbors, newmember)
+            neighbors, exneighbors = wvt_find_neighbors(binbuf[:binarea], neighborlist, neighbors, exneighbors, newmember)
 
             # Accretable neighbors are those that aren't already binned
             #neighbors_ind = numpy.where(neighbors > -1)[0]
             wh = numpy.where(binclass[neighbors] == 0)[0]
             # Stop if there aren't any accretable neighbors
             if len(wh) == 0:
+                if (not SNexact) and abs(SN - 0.8*targetSN) <= SNtol:
+                    SN = add_signal(signal[binbuf[:binarea]])/add_noise(noise[binbuf[:binarea]])
+                    SNexact = True
                 if SN > 0.8*targetSN:
-                    good[ currentBin] = 1
-                    binSN[currentBin] = SN
+                    good[binbuf[:binarea]] = 1
+                    binSN[binbuf[:binarea]] = SN
                 break
             # Otherwise keep only the accretable ones
             neighbors = neighbors[wh]
@@ -592,55 +994,83 @@ def wvt_bin_accretion(x, y, signal, noise, targetSN, dens,
             # Remember the old verified neighbors and the new members of the bin
             # exneighbors=neighbors
             newmember = neighbors[k]
-            nextBin   = numpy.append(currentBin, neighbors[k])
-            roundness = wvt_bin_roundness(x[nextBin], y[nextBin], pixelSize)
+            binbuf[binarea] = newmember     # the CANDIDATE bin is binbuf[:binarea+1]
+            nextarea = binarea + 1
+
+            # Roundness of the CANDIDATE bin: the new unweighted centroid moves
+            # by 'shift', so no old member can be further away than
+            # maxdist_hi+shift or closer than maxdist_lo-shift.
+            xnew   = float(x[newmember])
+            ynew   = float(y[newmember])
+            xcen   = sumx/binarea
+            ycen   = sumy/binarea
+            sumx  += xnew
+            sumy  += ynew
+            shift  = numpy.sqrt((sumx/nextarea-xcen)**2 + (sumy/nextarea-ycen)**2)
+            dist   = numpy.sqrt((xnew-sumx/nextarea)**2 + (ynew-sumy/nextarea)**2)
+            maxdist_hi = max(maxdist_hi + shift, dist)
+            maxdist_lo = max(maxdist_lo - shift, dist)
+            maxdist    = 2.*numpy.sqrt(float(nextarea)/numpy.pi)*pixelSize   # roundness = 1
+            if maxdist_hi < maxdist*(1.-1e-9):
+                roundness = 0.
+            elif maxdist_lo > maxdist*(1.+1e-9):
+                roundness = 2.
+            else:
+                roundness = wvt_bin_roundness(x[binbuf[:nextarea]], y[binbuf[:nextarea]], pixelSize)
+                maxdist_hi = maxdist_lo = (roundness+1.)*maxdist/2.
+                maxdist_hi *= 1.+1e-9
+                maxdist_lo *= 1.-1e-9
 
             # Compute the S/N one would obtain by adding
             # the CANDIDATE pixel to the current bin
-            SNOld = numpy.copy(SN)
-            SN = add_signal(signal[nextBin])/add_noise(noise[nextBin])
+            sumsignal += signal[newmember]
+            abssignal += abs(signal[newmember])
+            sumnoise2 += noise[newmember]**2
+            SN = sumsignal/numpy.sqrt(sumnoise2)
+            SNexact = False
+            # bound for the rounding difference to the old expression
+            SNtol = 8.*nextarea*eps*(abssignal/numpy.sqrt(sumnoise2) + abs(SN)) + 8.*eps*targetSN
 
             # Test whether the CANDIDATE pixel is connected to the
             # current bin, whether the POSSIBLE new bin is round enough
             # and whether the resulting S/N would get closer to targetSN
             if roundness > 1.:
+                if abs(SN - 0.8*targetSN) <= SNtol:
+                    SN = add_signal(signal[binbuf[:nextarea]])/add_noise(noise[binbuf[:nextarea]])
+                    SNexact = True
                 if SN > 0.8*targetSN:
-                    good[ currentBin] = 1
-                    binSN[currentBin] = SN
+                    good[binbuf[:binarea]] = 1
+                    binSN[binbuf[:binarea]] = SN
                 break
 
             # If all the above tests are negative then accept the CANDIDATE pixel,
             # add it to the current bin, and continue accreting pixels
-            binclass[neighbors[k]] = ind
-            currentBin = numpy.copy(nextBin)
-	    
-            # Update the centroid of the current bin
-            xbar, ybar, mass = wvt_addto_weighted_centroid(x[newmember], y[newmember], dens[newmember]**2, xbar, ybar, mass)
+            binclass[newmember] = ind
+
+            # Update the centroid of the current bin (same arithmetic as
+            # wvt_addto_weighted_centroid for a single pixel)
+            newmass = dens[newmember]**2
+            if newmass > 0 and mass+newmass > 0:
+                xbar = (x[newmember]*newmass + mass*xbar)/(mass+newmass)
+                ybar = (y[newmember]*newmass + mass*ybar)/(mass+newmass)
+                mass = mass+newmass
 
             binarea += 1    # Update the binarea of the bin
 
-        goodold    = good[currentBin[0]]
+        goodold    = good[binbuf[0]]
         binareaold = numpy.copy(binarea)
 
-        unBinned = numpy.where(binclass == 0)[0]
-        if len(unBinned) == 0: break      # Stop if all pixels are binned
-        binned = numpy.where(binclass != 0)[0]
+        nunbinned -= binarea
+        if nunbinned == 0: break      # Stop if all pixels are binned
         totarea += binareaold
 
         # Find the closest unbinned pixel to the centroid of all
         # the binned pixels, and start a new bin from that pixel.
-        k = numpy.argmin((x[unBinned]-xbar_start)**2 + (y[unBinned]-ybar_start)**2)
-        currentBin = numpy.asarray([unBinned[k]],dtype=numpy.int)        # The bin is initially made of one pixel
+        while binclass[seedorder[nextseed]] != 0: nextseed += 1
+        currentBin = numpy.asarray([seedorder[nextseed]],dtype=numpy.int)        # The bin is initially made of one pixel
         SN = add_signal(signal[currentBin])/add_noise(noise[currentBin])
 
-        if plot == True:
-            pylab.cla()
-            show_binclass(x, y, binclass*good)
-            pylab.show()
-
-#    if plot == True:
-#        #pylab.ioff()
-#        pylab.gca()
+        if plot: plot(x, y, binclass, good)
 
     # Set to zero all bins that did not reach the target S/N
     binclass *= good
@@ -656,13 +1086,10 @@ def wvt_reassign_bad_bins(x, y, binclass, quiet):
     # CLASS = 0 are unbinned pixels which are excluded.
     binclass = wvt_renumber_binclass(binclass, 1)
 
-    area = numpy.histogram(binclass, range(1, max(binclass)+2))[0]
-    good = numpy.where(area > 0)[0]     # Obtain the index of the good bins
-    xnode = numpy.zeros(len(good), dtype=numpy.float)
-    ynode = numpy.zeros(len(good), dtype=numpy.float)
-    for i in range(len(good)):
-        ind = numpy.where(binclass == good[i] + 1)[0]       # Find subscripts of pixels of each bin
-        xnode[i], ynode[i] = wvt_unweighted_centroid(x[ind], y[ind])
+    area, tmp, tmp, tmp, xbar, ybar = wvt_bin_quantities(binclass, x, y)[:6]
+    good = numpy.where(area[1:] > 0)[0]     # Obtain the index of the good bins
+    xnode = xbar[good + 1]
+    ynode = ybar[good + 1]
 
     if (quiet == False):
         f = pylab.figure()
@@ -671,9 +1098,7 @@ def wvt_reassign_bad_bins(x, y, binclass, quiet):
 
     # Reassign pixels to the closest centroid of a good bin
     bad  = numpy.where(binclass == 0)[0]
-    for i in bad:
-        ind = wvt_assign_to_bin_scale(x[i], y[i], xnode, ynode, 1.)
-        binclass[i] = good[ind] + 1
+    binclass[bad] = good[wvt_assign_all_to_bins(x[bad], y[bad], xnode, ynode, 1.)] + 1
 
     if (quiet == False):
         pylab.subplot(122)
@@ -683,22 +1108,71 @@ def wvt_reassign_bad_bins(x, y, binclass, quiet):
 
     # Recompute all centroids of the reassigned bins.
     # These will be used as starting point for the WVT.
-    area = numpy.histogram(binclass, range(0,(max(binclass)+2)))[0]
+    area, tmp, tmp, tmp, xbar, ybar = wvt_bin_quantities(binclass, x, y)[:6]
     good = numpy.where(area > 0)[0] # Re-obtain the index of the good bin
-    for i in range(len(good)):
-        ind = numpy.where(binclass == good[i])[0]       # Find subscripts of pixels in each bin
-        xnode[i], ynode[i] = wvt_unweighted_centroid(x[ind], y[ind])
+    xnode[:len(good)] = xbar[good]
+    ynode[:len(good)] = ybar[good]
 
     # No more "bad" bins with binnumber=0, i.e. start counting at 0!
     binclass = wvt_renumber_binclass(binclass, 0, area)
 
     return binclass, xnode, ynode
 
+def wvt_warm_start_binclass(x, y, xnode, ynode, scale):
+# Assigns the pixels to the generators and scale lengths of a previous
+# binning, as starting point of the WVT iteration instead of the bin accretion.
+# Generators without any pixel are removed.
+
+    # scale lengths are stored with 6 digits, avoid a division by zero
+    scale = numpy.maximum(scale, 1e-6)
+    binclass = wvt_assign_all_to_bins(x, y, xnode, ynode, 1./scale**2)
+
+    area = numpy.bincount(binclass, minlength=len(xnode))
+    good = numpy.where(area > 0)[0]
+    if len(good) < len(xnode):
+        binclass = (numpy.cumsum(area > 0)-1)[binclass]
+
+    return binclass, numpy.copy(xnode[good]), numpy.copy(ynode[good])
+
+def wvt_coarse_pixels(x, y, signal, noise, factor):
+# Sums the pixels in blocks of factor x factor pixels, the noise in quadrature.
+# Returns the block coordinates, signal and noise of all blocks containing
+# pixels, in the same (row by row) order as the pixels, and the block number
+# of each pixel.
+
+    width = numpy.max(x)//factor+1
+    key   = numpy.asarray(y//factor, dtype=numpy.int64)*width+x//factor
+    blocks, inverse = numpy.unique(key, return_inverse=True)
+
+    xc = blocks % width
+    yc = blocks // width
+    sc = numpy.bincount(inverse, weights=signal)
+    nc = numpy.sqrt(numpy.bincount(inverse, weights=numpy.asarray(noise, dtype=numpy.float)**2))
+
+    return xc, yc, sc, nc, inverse
+
 def wvt_equal_mass(x, y, signal, noise, targetSN, dens, binclass, neighborlist,
-                   xnode, ynode, max_area, max_iter, gersho ,quiet, plot):
+                   xnode, ynode, max_area, max_iter, gersho ,quiet, plot,
+                   save_all='', save_every=10, start_iter=0, history=None,
+                   incremental=False, nlevels=1, full_every=10, telemetry=None,
+                   refine=False):
 # Iteration with the new modified Lloyd algorithm that takes advantage of the
 # know average S/N per pixel to generate a WVT with equal S/N per bin.
 # Procedure described in Diehl & Statler (2005)
+# If save_all is a filename, the state of the iteration is stored there every
+# save_every iterations and at the end (see wvt_save_checkpoint). A stored
+# state is continued by passing its binclass, nodes, iteration number as
+# start_iter and its history. The difference of each iteration is appended
+# to the list history.
+# With incremental=True only the pixels of "dirty" bins (bins whose node or
+# scale changed, or which lost or gained pixels in the last iteration) and of
+# their bin neighbors up to nlevels are reassigned, and only among these bins.
+# Every full_every iterations, and before convergence is accepted, all pixels
+# are reassigned as usual.
+# telemetry: callback which gets a record of each iteration (see wvt_binning)
+# refine=True: the iteration only refines a given start (the coarse start of
+# wvt_binning) and max_iter is its planned number of iterations, so reaching
+# it is no reason for a warning
 
     npix  = len(x)
     nbins = len(xnode)
@@ -714,16 +1188,27 @@ def wvt_equal_mass(x, y, signal, noise, targetSN, dens, binclass, neighborlist,
     # the density is then defined as the square of the S/N ratio
     if gersho == True: dens2 = dens**2
 
-    #if (plot == True): pylab.ion()
+    if plot is True: plot = wvt_live_plot()
+
+    if history is None: history = []
+
+    # graph of neighboring bins, updated whenever pixels change their bin,
+    # and the KD-tree of the pixels for the repair of empty bins
+    adjacency = wvt_bin_adjacency(neighborlist, binclass, nbins)
+    pixeltree = spatial.cKDTree(numpy.column_stack((x, y)))
 
     # Start the iteration!
-    iter = 0   # number of iterations
+    iter = start_iter   # number of iterations
     diff = 1.
+    fullpass  = True    # all pixels reassigned in the last iteration
+    sincefull = 0       # number of iterations since the last full pass
 
-    while diff != 0. and iter <= max_iter:
+    while (diff != 0. or fullpass == False) and iter <= start_iter+max_iter:
 
+        titer = time.time()
         xnodeold = numpy.copy(xnode)
         ynodeold = numpy.copy(ynode)
+        binclassold = numpy.copy(binclass)
 
         # compute new binSN, area and number of bins
         binSN, area = wvt_calc_binSN(binclass, signal, noise)
@@ -738,47 +1223,88 @@ def wvt_equal_mass(x, y, signal, noise, targetSN, dens, binclass, neighborlist,
             binareaSN = numpy.ones(nbins, dtype=numpy.float)
 
         # Computes (Weighted) Voronoi Tessellation of the pixels grid
-        for i in range(npix):
-            binclass[i]  = wvt_assign_to_bin(x[i], y[i], xnode, ynode, binareaSN)
-        neighborbinclass = wvt_assign_neighbors(neighborlist, binclass)
+        fullpass = (incremental == False) or (iter == start_iter) or \
+                   (diff == 0.) or (sincefull >= full_every)
+        if fullpass:
+            binclass[:] = wvt_assign_all_to_bins(x, y, xnode, ynode, binareaSN)
+            sincefull = 0
+        else:
+            # only reassign the pixels in the neighborhood of the dirty bins
+            dirty[binareaSN != binareaSNold] = True
+            local = wvt_recursive_neighbors(adjacency, numpy.where(dirty)[0], nlevels)
+            inlocal = numpy.zeros(nbins, dtype=bool)
+            inlocal[local] = True
+            ind = numpy.where(inlocal[binclass])[0]
+            binclass[ind] = local[wvt_assign_all_to_bins(x[ind], y[ind], xnode[local],
+                                                         ynode[local], binareaSN[local])]
+            sincefull += 1
+        binareaSNold = binareaSN
 
         # Now make sure that still each bin has at least one pixel
-        binclass, area = wvt_check_all_bins(binclass, x, y, xnode, ynode)
+        tcheck = time.time()
+        if telemetry is not None: empty = numpy.bincount(binclass, minlength=nbins) == 0
+        binclass, area = wvt_check_all_bins(binclass, x, y, xnode, ynode, pixeltree)
+        tcheck = time.time()-tcheck
+
+        changed = numpy.where(binclass != binclassold)[0]
+        adjacency = wvt_update_bin_adjacency(adjacency, neighborlist, binclassold, binclass, changed)
 
         # Recompute the new node centers
         good = numpy.where(area > 0)[0] # Check for zero-size Voronoi bins
-        for i in good:
-            ind = numpy.where(binclass == i)[0]
-            if gersho == False:     # get actual positions of the nodes
-                xnode[i], ynode[i] = wvt_unweighted_centroid(x[ind], y[ind])
-            else:
-                xnode[i], ynode[i] = wvt_weighted_centroid(x[ind], y[ind], dens2[ind])
+        if gersho == False:     # get actual positions of the nodes
+            xbar, ybar = wvt_bin_quantities(binclass, x, y, nbins=nbins)[4:6]
+        else:
+            xbar, ybar = wvt_bin_quantities(binclass, x, y, density=dens2, nbins=nbins)[6:8]
+        xnode[good] = xbar[good]
+        ynode[good] = ybar[good]
 
         # Redistribute enclosed bins ("bin islands")
-        binclass, area = wvt_check_binislands(x, y, binclass, neighborbinclass, xnode, ynode)
+        tislands = time.time()
+        if telemetry is not None: nislands = numpy.sum(numpy.diff(adjacency.indptr) == 1)
+        binclass, area, adjacency = wvt_check_binislands(x, y, binclass, neighborlist,
+                                                         xnode, ynode, adjacency)
+        tcheck += time.time()-tislands
 
-        if plot == True:
-            pylab.cla()
-            show_binclass(x, y, binclass)
-            pylab.show()
+        if plot: plot(x, y, binclass)
 
         oldbinclass = numpy.copy(binclass)
         area = numpy.histogram(binclass, range(0, max(binclass)+2))[0]
         diff = numpy.sum((xnode-xnodeold)**2 + (ynode-ynodeold)**2)
 
+        if incremental == True:
+            # dirty bins for the next iteration
+            changed = numpy.where(binclass != binclassold)[0]
+            dirty = numpy.logical_or(xnode != xnodeold, ynode != ynodeold)
+            dirty[binclass[changed]]    = True
+            dirty[binclassold[changed]] = True
+
         if quiet == False:
             if iter > 0: print  r'Iteration: %3i | Difference: %5.4f %%' %(iter, diff)
             else:        print 'Initial WVT done.'
 
+        history.append(diff)
+        if telemetry is not None:
+            telemetry({'event': 'iteration', 'iteration': iter, 'diff': float(diff),
+                       'time': time.time()-titer, 'time_checks': tcheck,
+                       'full_pass': bool(fullpass), 'nbins': nbins,
+                       'pixels_reassigned': int(numpy.sum(binclass != binclassold)),
+                       'bins_repaired': int(numpy.sum(empty & (area > 0))),
+                       'islands_merged': int(nislands)})
         iter += 1
 
+        if (save_all != '') and (iter % save_every == 0):
+            wvt_save_checkpoint(save_all, binclass, xnode, ynode,
+                                numpy.sqrt(1./binareaSN), iter, history)
+
 #    if plot == True:
 #        pylab.cla()
 
     if diff == 0.:
         print "Iteration converged to a stable WVT solution"
 
-    if iter > max_iter:
+    if iter > start_iter+max_iter and refine:
+        print 'Refinement stopped after %i iterations.' %(max_iter)
+    elif iter > start_iter+max_iter:
         print 'Iteration reached maximum number of iterations. This should'
         print 'not happen in general except for data with an extremely large'
         print 'dynamical range. Check your input files and/or restart the'
@@ -786,6 +1312,10 @@ def wvt_equal_mass(x, y, signal, noise, targetSN, dens, binclass, neighborlist,
 
     scale = numpy.sqrt(1./binareaSN)
 
+    if save_all != '':
+        wvt_save_checkpoint(save_all, binclass, xnode, ynode, scale, iter, history)
+        print 'WVT iteration stored in '+save_all
+
     # return the generators and scales of the weighted Voronoi bins
     return binclass, xnode, ynode, scale, area
 
@@ -805,18 +1335,202 @@ def read_fits(filename):
 
     return header, data
 
+def read_binning_input(signalfile, noisefile, noise_mode='sig', mask='', compact=False):
+# reads the signal and noise fits files (memory mapped) and returns the
+# coordinates, signal and noise of the valid pixels and the size of the image.
+# The pixels are returned row by row, i.e. in the order of the image.
+# noise_mode = 'var': the noise file contains the variance
+# mask = '':    pixels with signal != 0 are valid
+#        'nan': pixels with finite signal and noise are valid
+#        fits file or array of the size of the image: pixels with mask != 0
+#               and finite signal and noise are valid
+# compact=True: int32 coordinates and float32 signal and noise instead of
+#               int and float, which halves the memory of the pixel lists
+
+    hdusignal  = pyfits.open(signalfile, memmap=True)
+    hdunoise   = pyfits.open(noisefile,  memmap=True)
+    datasignal = hdusignal[0].data
+    datanoise  = hdunoise[0].data
+    size = datasignal.shape
+
+    if isinstance(mask, str) and mask == '':
+        valid = datasignal != 0
+    else:
+        valid = numpy.logical_and(numpy.isfinite(datasignal), numpy.isfinite(datanoise))
+        if not (isinstance(mask, str) and mask == 'nan'):
+            if isinstance(mask, str): mask = read_fits(mask)[1]
+            if numpy.shape(mask) != size:
+                raise ValueError('mask must have the size of the image %s' %(size,))
+            valid = numpy.logical_and(valid, mask != 0)
+
+    if compact == True:
+        coordtype, valuetype = numpy.int32, numpy.float32
+    else:
+        coordtype, valuetype = numpy.int, numpy.float
+
+    y, x   = numpy.nonzero(valid)
+    signal = datasignal[y, x].astype(valuetype)
+    noise  = datanoise[y, x]
+    if (noise_mode == 'var'): noise = numpy.sqrt(noise)
+    noise  = noise.astype(valuetype)
+    x = x.astype(coordtype)
+    y = y.astype(coordtype)
+
+    hdusignal.close()
+    hdunoise.close()
+
+    return x, y, signal, noise, size
+
+def wvt_save_checkpoint(filename, binclass, xnode, ynode, scale, iteration, history):
+# stores the state of the WVT iteration (bin numbers of the pixels, generators,
+# scale lengths, number of finished iterations and the difference of each
+# iteration) in a compressed numpy file. The file is written under a temporary
+# name first, so an interrupted run never leaves a broken checkpoint.
+
+    tmpfile = filename+'.tmp'
+    out = open(tmpfile, 'wb')
+    numpy.savez_compressed(out, binclass=numpy.asarray(binclass, dtype=numpy.int32),
+                           xnode=xnode, ynode=ynode, scale=scale,
+                           iteration=iteration,
+                           history=numpy.asarray(history, dtype=numpy.float))
+    out.close()
+    os.rename(tmpfile, filename)
+
+def wvt_load_checkpoint(filename):
+# reads a checkpoint written by wvt_save_checkpoint
+
+    data = numpy.load(filename)
+    binclass  = data['binclass'].astype(numpy.int)
+    xnode     = data['xnode']
+    ynode     = data['ynode']
+    scale     = data['scale']
+    iteration = int(data['iteration'])
+    history   = list(data['history'])
+    data.close()
+
+    return binclass, xnode, ynode, scale, iteration, history
+
+def wvt_telemetry_phase(telemetry, phase, start, **counts):
+# reports the time since start of the phase (and optional counters) to the
+# telemetry callback and returns the current time as start of the next phase
+
+    if telemetry is not None:
+        record = {'event': 'phase', 'phase': phase, 'time': time.time()-start}
+        record.update(counts)
+        telemetry(record)
+
+    return time.time()
+
+def wvt_telemetry_report(filename):
+# returns a telemetry callback for wvt_binning / binning_fits which sums the
+# times of the phases and the counters, keeps the record of every WVT
+# iteration (convergence trace) and writes all of it to the JSON file
+# filename after every phase
+
+    report = {'phases': {}, 'counters': {}, 'iterations': []}
+    counters = ('pixels_reassigned', 'bins_repaired', 'islands_merged')
+
+    def telemetry(record):
+        if record['event'] == 'iteration':
+            report['iterations'].append(record)
+            for key in counters:
+                report['counters'][key] = report['counters'].get(key, 0)+record[key]
+            return
+        phase = record['phase']
+        report['phases'][phase] = report['phases'].get(phase, 0.)+record['time']
+        for key in record:
+            if key not in ('event', 'phase', 'time'):
+                name = phase+'_'+key
+                report['counters'][name] = report['counters'].get(name, 0)+record[key]
+        out = open(filename, 'w')
+        json.dump(report, out, indent=1, sort_keys=True)
+        out.close()
+
+    return telemetry
+
+def read_binning_generators(filename):
+# reads the generators and scale lengths of a previous binning from its
+# .voronoi.bin.dat or .voronoi.fits file or from a checkpoint of
+# wvt_save_checkpoint (.npz)
+
+    if filename.endswith('.npz'):
+        xnode, ynode, scale = wvt_load_checkpoint(filename)[1:4]
+    elif filename.endswith('.fits'):
+        bins  = pyfits.getdata(filename, 'BINS')
+        xnode = numpy.array(bins['XNODE'], dtype=numpy.float)
+        ynode = numpy.array(bins['YNODE'], dtype=numpy.float)
+        scale = numpy.array(bins['SCALE'], dtype=numpy.float)
+    else:
+        table = numpy.loadtxt(filename, ndmin=2)
+        xnode = table[:,1]
+        ynode = table[:,2]
+        scale = table[:,9]
+
+    return xnode, ynode, scale
+
+def read_binning_pixels(filename):
+# reads the coordinates and bin numbers (starting at 0) of the pixels of a
+# previous binning from its .voronoi.pixel.dat or .voronoi.fits file
+
+    if filename.endswith('.fits'):
+        pixels = pyfits.getdata(filename, 'PIXELS')
+        return (numpy.array(pixels['X'], dtype=numpy.int), numpy.array(pixels['Y'], dtype=numpy.int),
+                numpy.array(pixels['BINNR'], dtype=numpy.int)-1)
+
+    table = numpy.loadtxt(filename, usecols=(0,1,2), dtype=numpy.int, ndmin=2)
+
+    return table[:,0], table[:,1], table[:,2]-1
+
 def write_fits(array, header, filename):
 # write a numpy-array to a fits file with a header, creates automatic header when header = '0'
 
     hdu_out = pyfits.PrimaryHDU(array)
     if (header != 0):
         hdu_out.header = header
-    os.system('rm -f ' +filename)
+    if os.path.exists(filename): os.remove(filename)
     hdu_out.writeto(filename)
 
+def write_binning_fits(x, y, signal, noise, filename, size, binclass,
+                       xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale,
+                       valid_SN, valid_area):
+# stores the binning results in one multi-extension fits file:
+# primary:  bin_map with the binNr of each pixel (-1 for unbinned pixels)
+# BINS:     table with the same columns as ..._bin.dat and a VALID flag
+# PIXELS:   table of the binned pixels with X, Y, BINNR, SIGNAL, NOISE, SN
+
+    bin_arr = numpy.zeros(size, dtype=numpy.int32)-1
+    bin_arr[y, x] = binclass+1
+
+    max_sn_bin = numpy.argmax(binSN)
+    distance = numpy.sqrt((xbar[max_sn_bin]-xbar)**2 + (ybar[max_sn_bin]-ybar)**2)
+    valid = numpy.logical_and(binSN >= valid_SN, area < valid_area)
+    bins = pyfits.BinTableHDU.from_columns([
+        pyfits.Column(name='BINNR',    format='J', array=numpy.arange(1, len(xnode)+1)),
+        pyfits.Column(name='XNODE',    format='D', array=xnode),
+        pyfits.Column(name='YNODE',    format='D', array=ynode),
+        pyfits.Column(name='XBAR',     format='D', array=xbar),
+        pyfits.Column(name='YBAR',     format='D', array=ybar),
+        pyfits.Column(name='SIGNAL',   format='D', array=binsignal),
+        pyfits.Column(name='NOISE',    format='D', array=binnoise),
+        pyfits.Column(name='SN',       format='D', array=binSN),
+        pyfits.Column(name='NPIX',     format='J', array=area),
+        pyfits.Column(name='SCALE',    format='D', array=scale),
+        pyfits.Column(name='DISTANCE', format='D', array=distance),
+        pyfits.Column(name='VALID',    format='L', array=valid)], name='BINS')
+    pixels = pyfits.BinTableHDU.from_columns([
+        pyfits.Column(name='X',      format='J', array=x),
+        pyfits.Column(name='Y',      format='J', array=y),
+        pyfits.Column(name='BINNR',  format='J', array=binclass+1),
+        pyfits.Column(name='SIGNAL', format='D', array=signal),
+        pyfits.Column(name='NOISE',  format='D', array=noise),
+        pyfits.Column(name='SN',     format='D', array=signal/noise)], name='PIXELS')
+
+    if os.path.exists(filename): os.remove(filename)
+    pyfits.HDUList([pyfits.PrimaryHDU(bin_arr), bins, pixels]).writeto(filename)
+
 def write_binning_results(x, y, signal, noise, outfile_prefix, size, binclass,
                           xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale,
-                          full_output, valid_out, valid_SN, valid_area):
+                          full_output, valid_out, valid_SN, valid_area, fits_output=False):
 # stores binning results in two asciifiles and four fits-files
 # ..._bin.dat:         information of each computed bin: position of generators
 #                      and flux-weighted centroids, signal, noise, number of pixels,
@@ -827,87 +1541,72 @@ def write_binning_results(x, y, signal, noise, outfile_prefix, size, binclass,
 # ..._bin_signal.fits: bin_map: each bin has his signal as value
 # ..._bin_noise.fits:  bin_map: each bin has his noise as value
 # ..._bin_sn.fits:     bin_map: each bin has his S/N as value
+# fits_output=True additionally stores everything in ....voronoi.fits
+# (see write_binning_fits)
 
-    # ascii-output
-    if (valid_out == 0) or (valid_out ==2):
-	table_file = open(outfile_prefix+'.voronoi.pixel.dat','w')
-	table_file.write('#    X      Y   binNr      signal           noise               sn              distance\n')
-        print 'storing binnumbers in ' +outfile_prefix+'.voronoi.pixel.dat'
-        max_sn_bin = numpy.argmax(signal/noise)
-        for i in range(len(x)):
-	    table_file.write('%d\t%6i\t%6i\t%16.6e\t%16.6e\t%16.6f\n'%(x[i],y[i],binclass[i] + 1, signal[i], signal[i]/noise[i],numpy.sqrt((x[max_sn_bin]-x[i])**2 + (y[max_sn_bin]-y[i])**2)))
-        table_file.close()
-
-	table_file = open(outfile_prefix+'.voronoi.bin.dat','w')
-	table_file.write('# binNr         xnode            ynode            xbar             ybar\
-            signal           noise               sn        pixNr        scale           distance\n')
-        print 'storing bin properties in '+outfile_prefix+'.voronoi.bin.dat'
-        max_sn_bin = numpy.argmax(binSN)
-        for i in range(len(xnode)):
-	    table_file.write('%d\t%16.6f\t%16.6f\t%16.6f\t%16.6f\t%16.6e\t%16.6e\t%16.6f\t%5i\t%16.6f\t%16.6f\n'%(i +1 ,xnode[i],ynode[i],xbar[i],ybar[i],binsignal[i], binnoise[i], binSN[i], area[i], scale[i], numpy.sqrt((xbar[max_sn_bin]-xbar[i])**2 + (ybar[max_sn_bin]-ybar[i])**2)))
-        table_file.close()
-
-        if full_output == True:
-            # re-ararranging results for output
-            signal_arr = numpy.zeros(size, dtype=numpy.float)
-            noise_arr  = numpy.zeros(size, dtype=numpy.float)
-            bin_arr    = numpy.zeros(size, dtype=numpy.float)-1
-            sn_arr     = numpy.zeros(size, dtype=numpy.float)
-            for i in range(len(x)):
-                bin_arr[   y[i], x[i]] = binclass[i] + 1
-                signal_arr[y[i], x[i]] = binsignal[binclass[i]]
-                noise_arr[ y[i], x[i]] = binnoise[binclass[i]]
-                sn_arr[    y[i], x[i]] = binSN[binclass[i]]
-
-            # fits-output
-            write_fits(signal_arr, 0, outfile_prefix+'.bin.fits')
-            write_fits(noise_arr,  0, outfile_prefix+'.bin.sig.fits')
-            write_fits(bin_arr,    0, outfile_prefix+'.bin.nr.fits')
-            write_fits(sn_arr,     0, outfile_prefix+'.bin.sn.fits')
+    max_sn_pix = numpy.argmax(signal/noise)
+    max_sn_bin = numpy.argmax(binSN)
 
+    outputs = []
+    if (valid_out == 0) or (valid_out ==2):
+        outputs.append((numpy.arange(len(x)), numpy.arange(len(xnode)), '%d', '', ''))
     if (valid_out == 1) or (valid_out == 2):
         select_bin = numpy.where(numpy.logical_and(binSN >= valid_SN, area < valid_area) == True)[0]
-        select_pix = numpy.zeros(0,dtype=numpy.int)
-        for i in select_bin:
-            select_pix = numpy.append(select_pix, numpy.where(binclass == i)[0])
-	
-	
-	table_file = open(outfile_prefix+'.voronoi.pixel.valid.dat','w')
-	table_file.write('#    X      Y   binNr      signal           noise               sn              distance\n')
-        print 'storing valid binnumbers in ' +outfile_prefix+'.voronoi.pixel.dat'
-        max_sn_bin = numpy.argmax(signal/noise)
-        for i in range(len(select_pix)):
-	    table_file.write('%6i\t%6i\t%6i\t%16.6e\t%16.6e\t%16.6f\n'%(x[select_pix[i]],y[select_pix[i]],binclass[select_pix[i]] + 1, signal[select_pix[i]], signal[select_pix[i]]/noise[select_pix[i]],numpy.sqrt((x[max_sn_bin]-x[select_pix[i]])**2 + (y[max_sn_bin]-y[select_pix[i]])**2)))
+        # pixels ordered by the selected bins, in their original order within a bin
+        selected = numpy.zeros(len(xnode), dtype=bool)
+        selected[select_bin] = True
+        select_pix = numpy.where(selected[binclass])[0]
+        select_pix = select_pix[numpy.argsort(binclass[select_pix], kind='mergesort')]
+        outputs.append((select_pix, select_bin, '%6i', '.valid', ' valid'))
+
+    # ascii-output
+    for select_pix, select_bin, xfmt, suffix, text in outputs:
+        table_file = open(outfile_prefix+'.voronoi.pixel'+suffix+'.dat','w')
+        table_file.write('#    X      Y   binNr      signal           noise               sn              distance\n')
+        print 'storing'+text+' binnumbers in ' +outfile_prefix+'.voronoi.pixel'+suffix+'.dat'
+        xs = x[select_pix]
+        ys = y[select_pix]
+        numpy.savetxt(table_file, numpy.column_stack((xs, ys, binclass[select_pix] + 1,
+                      signal[select_pix], signal[select_pix]/noise[select_pix],
+                      numpy.sqrt((x[max_sn_pix]-xs)**2 + (y[max_sn_pix]-ys)**2))),
+                      fmt=xfmt+'\t%6i\t%6i\t%16.6e\t%16.6e\t%16.6f', newline='\n')
         table_file.close()
-        
-        
+
         table_file = open(outfile_prefix+'.voronoi.bin.dat','w')
-	table_file.write('# binNr         xnode            ynode            xbar             ybar\
+        table_file.write('# binNr         xnode            ynode            xbar             ybar\
             signal           noise               sn        pixNr        scale           distance\n')
         print 'storing bin properties in '+outfile_prefix+'.voronoi.bin.dat'
-        max_sn_bin = numpy.argmax(binSN)
-        for i in range(len(select_bin)):
-	    table_file.write('%d\t%16.6f\t%16.6f\t%16.6f\t%16.6f\t%16.6e\t%16.6e\t%16.6f\t%5i\t%16.6f\t%16.6f\n'%(select_bin[i] +1 ,xnode[select_bin[i]],ynode[select_bin[i]],xbar[select_bin[i]],ybar[select_bin[i]],binsignal[select_bin[i]], binnoise[select_bin[i]], binSN[select_bin[i]], area[select_bin[i]], scale[select_bin[i]], numpy.sqrt((xbar[max_sn_bin]-xbar[select_bin[i]])**2 + (ybar[max_sn_bin]-ybar[select_bin[i]])**2)))
+        i = select_bin
+        numpy.savetxt(table_file, numpy.column_stack((i + 1, xnode[i], ynode[i], xbar[i], ybar[i],
+                      binsignal[i], binnoise[i], binSN[i], area[i], scale[i],
+                      numpy.sqrt((xbar[max_sn_bin]-xbar[i])**2 + (ybar[max_sn_bin]-ybar[i])**2))),
+                      fmt='%d\t%16.6f\t%16.6f\t%16.6f\t%16.6f\t%16.6e\t%16.6e\t%16.6f\t%5i\t%16.6f\t%16.6f',
+                      newline='\n')
         table_file.close()
 
-
         if full_output == True:
             # re-ararranging results for output
             signal_arr = numpy.zeros(size, dtype=numpy.float)
             noise_arr  = numpy.zeros(size, dtype=numpy.float)
             bin_arr    = numpy.zeros(size, dtype=numpy.float)-1
             sn_arr     = numpy.zeros(size, dtype=numpy.float)
-            for i in range(len(select_pix)):
-                bin_arr[   y[select_pix[i]], x[select_pix[i]]] = binclass[select_pix[i]] + 1
-                signal_arr[y[select_pix[i]], x[select_pix[i]]] = binsignal[binclass[select_pix[i]]]
-                noise_arr[ y[select_pix[i]], x[select_pix[i]]] = binnoise[binclass[select_pix[i]]]
-                sn_arr[    y[select_pix[i]], x[select_pix[i]]] = binSN[binclass[select_pix[i]]]
+            pixclass   = binclass[select_pix]
+            bin_arr[   ys, xs] = pixclass + 1
+            signal_arr[ys, xs] = binsignal[pixclass]
+            noise_arr[ ys, xs] = binnoise[pixclass]
+            sn_arr[    ys, xs] = binSN[pixclass]
 
             # fits-output
-            write_fits(signal_arr, 0, outfile_prefix+'.bin.valid.fits')
-            write_fits(noise_arr,  0, outfile_prefix+'.bin.sig.valid.fits')
-            write_fits(bin_arr,    0, outfile_prefix+'.bin.nr.valid.fits')
-            write_fits(sn_arr,     0, outfile_prefix+'.bin.sn.valid.fits')
+            write_fits(signal_arr, 0, outfile_prefix+'.bin'+suffix+'.fits')
+            write_fits(noise_arr,  0, outfile_prefix+'.bin.sig'+suffix+'.fits')
+            write_fits(bin_arr,    0, outfile_prefix+'.bin.nr'+suffix+'.fits')
+            write_fits(sn_arr,     0, outfile_prefix+'.bin.sn'+suffix+'.fits')
+
+    if fits_output == True:
+        print 'storing binning results in '+outfile_prefix+'.voronoi.fits'
+        write_binning_fits(x, y, signal, noise, outfile_prefix+'.voronoi.fits', size, binclass,
+                           xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale,
+                           valid_SN, valid_area)
 
 
 ################################################################################
@@ -917,7 +1616,39 @@ def write_binning_results(x, y, signal, noise, outfile_prefix, size, binclass,
 ################################################################################
 def wvt_binning(x, y, signal, noise, targetSN , dens,
                 pixelSize, center, gersho, max_area, max_iter, quiet, plot,
-                valid_SN, valid_area):
+                valid_SN, valid_area, save_all='', save_every=10, resume='',
+                incremental=False, neighborlist=None, warm_start='', coarse=1,
+                refine_iter=10, nlevels=1, full_every=10, telemetry=None):
+# save_all:    filename for checkpoints of the WVT iteration (see wvt_equal_mass)
+# resume:      checkpoint file from which the WVT iteration is continued, the
+#              accretion and reassignment steps are skipped
+# warm_start:  .voronoi.bin.dat, .voronoi.fits or checkpoint file of a previous
+#              binning of (nearly) the same data, whose generators are used as
+#              starting point of the WVT iteration instead of the bin accretion.
+#              The number of changed bins is reported, if the old pixel
+#              assignment is available
+# incremental: only reassign the pixels around changed bins in most of the
+#              WVT iterations (see wvt_equal_mass)
+# nlevels, full_every: levels of bin neighbors that are reassigned with the
+#              changed bins, and number of iterations between the full
+#              reassignments of all pixels in the incremental mode
+# neighborlist: neighbor list of the pixels (wvt_make_neighborlist), if it is
+#              already known
+# coarse:      if > 1, the pixels are first summed in blocks of coarse x coarse
+#              pixels (wvt_coarse_pixels) and binned. The generators of this
+#              binning, projected to the full resolution, are the starting
+#              point of the WVT iteration instead of the bin accretion.
+# refine_iter: maximal number of WVT iterations after the coarse start, which
+#              only has to refine the projected generators (0: max_iter)
+# plot:        True or a callback of wvt_live_plot (e.g. for snapshots) to
+#              follow the accretion and the WVT iteration on a map
+# telemetry:   callback (e.g. wvt_telemetry_report) called with a dict for
+#              each phase {'event': 'phase', 'phase': name, 'time': seconds,
+#              counters...} (phases neighborlist, accretion, reassign,
+#              resume, warm_start, coarse, wvt) and for each WVT iteration
+#              {'event': 'iteration', 'iteration', 'diff', 'time',
+#              'time_checks', 'full_pass', 'nbins', 'pixels_reassigned',
+#              'bins_repaired', 'islands_merged'}
 
     npix = len(x)
 
@@ -943,33 +1674,134 @@ def wvt_binning(x, y, signal, noise, targetSN , dens,
     noise[numpy.where(noise == 0)] = numpy.min(noise[numpy.where(noise > 0)])*1e-9
 
     if (len(dens) != npix):
-        dens = numpy.zeros(npix, numpy.float)
-        for i in range(npix): dens[i] = float(signal[i])/float(noise[i])
+        dens = numpy.asarray(signal, dtype=numpy.float)/numpy.asarray(noise, dtype=numpy.float)
 
     # This is the main routine.
     # It simply calls in sequence the different steps of the algorithms and
     # optionally plots the results at the end of the calculation.
-    print 'bin-accretion...'
-    binclass, neighborlist = wvt_bin_accretion(x, y, signal, noise, targetSN, dens,
-                                               pixelSize, center, max_area, quiet, plot)
-    print numpy.max(binclass), ' initial bins.'
+    if plot is True: plot = wvt_live_plot()
+
+    start = time.time()
+    if neighborlist is None:
+        print '...making neighbor list...'
+        neighborlist = wvt_make_neighborlist(x, y)
+        start = wvt_telemetry_phase(telemetry, 'neighborlist', start)
+
+    refine = False   # True if refine_iter caps the WVT iteration
+    if resume != '':
+        print 'Resume WVT iteration from '+resume+'...'
+        binclass, xnode, ynode, scale, start_iter, history = wvt_load_checkpoint(resume)
+        if len(binclass) != npix:
+            raise ValueError('Checkpoint '+resume+' does not match the input pixels')
+        print len(xnode), ' bins after ', start_iter, ' iterations.'
+        start = wvt_telemetry_phase(telemetry, 'resume', start)
+
+    elif warm_start != '':
+        print 'Warm start from '+warm_start+'...'
+        xnode, ynode, scale = read_binning_generators(warm_start)
+        binclass, xnode, ynode = wvt_warm_start_binclass(x, y, xnode, ynode, scale)
+        print len(xnode), ' bins.'
+        start_iter = 0
+        history    = []
+
+        # previous bin numbers of the pixels
+        binclassold = None
+        if warm_start.endswith('.npz'):
+            binclassold = wvt_load_checkpoint(warm_start)[0]
+            if len(binclassold) != npix: binclassold = None
+            areaold = None
+        else:
+            pixelfile = warm_start.replace('.voronoi.bin.dat', '.voronoi.pixel.dat')
+            if (pixelfile != warm_start or warm_start.endswith('.fits')) and \
+               os.path.exists(pixelfile):
+                xold, yold, classold = read_binning_pixels(pixelfile)
+                binclassold = numpy.zeros(npix, dtype=numpy.int)-1
+                index = wvt_match_pixels(x, y, xold, yold)
+                binclassold[index >= 0] = classold[index[index >= 0]]
+                areaold = numpy.bincount(classold)
+        start = wvt_telemetry_phase(telemetry, 'warm_start', start)
+
+    elif coarse > 1:
+        print 'Coarse binning of %ix%i pixel blocks...' %(coarse, coarse)
+        xc, yc, sc, nc, block = wvt_coarse_pixels(x, y, signal, noise, coarse)
+        if len(center) == 2: centerc = [center[0]//coarse, center[1]//coarse]
+        else:                centerc = []
+        coarseresult = wvt_binning(xc, yc, sc, nc, targetSN, [], pixelSize, centerc, gersho,
+                                   int(numpy.ceil(float(max_area)/coarse**2)), max_iter,
+                                   quiet, False, valid_SN, float(valid_area)/coarse**2)
+        coarseclass, xnode, ynode = coarseresult[0:3]
+        coarsearea, scale = coarseresult[8:10]
+        print '...back to full resolution...'
+        xnode = (xnode+0.5)*coarse-0.5
+        ynode = (ynode+0.5)*coarse-0.5
+        scale = scale*coarse
+
+        # bins of a single block may contain several bins at full resolution:
+        # replace them by the bins of an accretion of their pixels
+        single = coarsearea[coarseclass[block]] == 1
+        if numpy.sum(single) > 1:
+            ind = numpy.where(single)[0]
+            fineclass = wvt_bin_accretion(x[ind], y[ind], signal[ind], noise[ind], targetSN,
+                                          dens[ind], pixelSize, [], max_area, True, False)[0]
+            if numpy.max(fineclass) > 0:
+                fineclass, finexnode, fineynode = wvt_reassign_bad_bins(x[ind], y[ind],
+                                                                        fineclass, True)
+                finearea, finesignal, finenoise, fineSN = \
+                    wvt_bin_quantities(fineclass, signal=signal[ind], noise=noise[ind])[:4]
+                keep  = coarsearea > 1
+                xnode = numpy.concatenate((xnode[keep], finexnode))
+                ynode = numpy.concatenate((ynode[keep], fineynode))
+                scale = numpy.concatenate((scale[keep], numpy.sqrt(finearea/numpy.abs(fineSN))))
+                print numpy.sum(~keep), ' single block bins split into ', len(finexnode), ' bins.'
+
+        binclass, xnode, ynode = wvt_warm_start_binclass(x, y, xnode, ynode, scale)
+        print len(xnode), ' bins.'
+        start_iter = 0
+        history    = []
+        if refine_iter > 0 and (max_iter == 0 or refine_iter < max_iter):
+            max_iter = refine_iter
+            refine   = True
+        start = wvt_telemetry_phase(telemetry, 'coarse', start)
 
-    print 'Reassign bad bins...'
-    binclass, xnode, ynode = wvt_reassign_bad_bins(x, y, binclass, quiet)
-    print len(xnode), ' good bins.'
+    else:
+        print 'bin-accretion...'
+        binclass, neighborlist = wvt_bin_accretion(x, y, signal, noise, targetSN, dens,
+                                                   pixelSize, center, max_area, quiet, plot,
+                                                   neighborlist)
+        print numpy.max(binclass), ' initial bins.'
+        start = wvt_telemetry_phase(telemetry, 'accretion', start,
+                                    bins=int(numpy.max(binclass)))
+        if numpy.max(binclass) == 0:
+            raise NoBinError('The bin accretion found no bin with enough S/N')
+
+        print 'Reassign bad bins...'
+        nbad = numpy.sum(binclass == 0)
+        binclass, xnode, ynode = wvt_reassign_bad_bins(x, y, binclass, quiet)
+        print len(xnode), ' good bins.'
+        start_iter = 0
+        history    = []
+        start = wvt_telemetry_phase(telemetry, 'reassign', start, pixels=int(nbad))
 
     print 'Extremely modified Lloyd algorithm...'
     binclass, xnode, ynode, scale, area = \
         wvt_equal_mass(x, y, signal, noise, targetSN, dens, binclass, neighborlist,
-                       xnode, ynode, max_area, max_iter, gersho, quiet, plot)
+                       xnode, ynode, max_area, max_iter, gersho, quiet, plot,
+                       save_all, save_every, start_iter, history, incremental,
+                       nlevels, full_every, telemetry=telemetry, refine=refine)
+    start = wvt_telemetry_phase(telemetry, 'wvt', start,
+                                iterations=len(history)-start_iter)
+    if plot: plot(x, y, binclass, final=True)
+
+    if resume == '' and warm_start != '' and binclassold is not None:
+        partner = wvt_compare_binclass(binclass, binclassold, areaold)
+        print '%i of %i bins changed compared to %s.' %(numpy.sum(partner < 0), len(xnode),
+                                                        warm_start)
 
     xbar, ybar, binsignal, binnoise, binSN = compute_bin_quantities(x, y, signal, noise, binclass)
 
     w1 = area == 1
-    w2 = area > 1
-    w3 = numpy.logical_and(binSN >= valid_SN, area < valid_area)
-    w4 = numpy.logical_and(w2, w3)
-    averageSN = numpy.mean(binSN[w4])
+    nvalid, averageSN, scatter_target, scatter_average = \
+        wvt_binning_statistics(binSN, area, targetSN, valid_SN, valid_area)
     print '----------------------------------------------------'
     print 'Validation thresholds:'
     print '     S/N      = %.2f' %(valid_SN)
@@ -977,13 +1809,209 @@ def wvt_binning(x, y, signal, noise, targetSN , dens,
     print '----------------------------------------------------'
     print 'Binning results:'
     print '     Binned pixels:  %i/%i = %.2f%%' %(npix-len(w1), npix, float(npix-len(w1))/float(npix)*100.)
-    print '     Valid bins:     %i/%i = %.2f%%' %(numpy.sum(w4)+numpy.sum(w1), len(xnode), float(numpy.sum(w4)+numpy.sum(w1))/float(len(xnode))*100.)
+    print '     Valid bins:     %i/%i = %.2f%%' %(nvalid, len(xnode), float(nvalid)/float(len(xnode))*100.)
     print '----------------------------------------------------'
     print 'S/N statistics for valid binned pixel:'
     print '     target S/N:     %.2f'    %(targetSN)
     print '     average S/N:    %.2f'    %(averageSN)
-    print '     S/N scatter around target S/N:  %.2f %%' %(numpy.std((binSN[w4]-targetSN)/targetSN)*100.)
-    print '     S/N scatter around average S/N: %.2f %%' %(numpy.std((binSN[w4]-averageSN)/averageSN)*100.)
+    print '     S/N scatter around target S/N:  %.2f %%' %(scatter_target*100.)
+    print '     S/N scatter around average S/N: %.2f %%' %(scatter_average*100.)
+    print '----------------------------------------------------'
+
+    return binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale
+
+def wvt_binning_components(x, y, signal, noise, targetSN, gersho, max_area, max_iter,
+                           valid_SN, valid_area, incremental=False, nworkers=0,
+                           dens=[], pixelSize=1., center=[], quiet=True, coarse=1,
+                           refine_iter=10, nlevels=1, full_every=10, telemetry=None):
+# Bins each connected component (4-connectivity) of the pixel mask on its own,
+# in a pool of nworkers processes (0: one per CPU), since the bin accretion
+# cannot grow bins across gaps anyway. The bins of all components are numbered
+# consecutively in the order of the components. The pixels of components which
+# do not reach targetSN are assigned to the closest centroid of the good bins,
+# as the bad bins in wvt_reassign_bad_bins.
+# dens, pixelSize, quiet, coarse, refine_iter, nlevels and full_every are
+# passed to the wvt_binning of each component, center only to the component
+# with the pixel closest to it. The telemetry records of the components are collected in the workers
+# and passed to telemetry with the number of the component ('component').
+# Returns the same quantities as wvt_binning.
+
+    npix = len(x)
+    if max_area == 0: max_area = npix   # maximal bin area
+
+    # prevent division by zero for pixels with noise = 0
+    noise[numpy.where(noise == 0)] = numpy.min(noise[numpy.where(noise > 0)])*1e-9
+
+    size   = (numpy.max(y)+1, numpy.max(x)+1)
+    groups = _wvt_label_groups(x, y, size, numpy.ones(npix, dtype=bool))
+    print len(groups), ' connected components'
+
+    options = {'max_area': max_area, 'max_iter': max_iter, 'gersho': gersho,
+               'incremental': incremental, 'pixelSize': pixelSize, 'quiet': quiet,
+               'coarse': coarse, 'refine_iter': refine_iter, 'nlevels': nlevels,
+               'full_every': full_every}
+    if nworkers == 0: nworkers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(max(1, min(nworkers, len(groups))))
+    try:
+        results = _wvt_bin_groups(x, y, signal, noise, groups, targetSN, options, pool,
+                                  dens, center, telemetry)
+    finally:
+        pool.close()
+        pool.join()
+
+    binclass = numpy.zeros(npix, dtype=numpy.int)-1
+    nodes = []
+    nbins = _wvt_add_bins(binclass, nodes, groups, results)
+    if nbins == 0:
+        raise ValueError('Not enough S/N in any connected component for a single bin')
+    xnode, ynode, scale = [numpy.concatenate(node) for node in zip(*nodes)]
+    print nbins, ' bins in ', numpy.sum([r is not None for r in results]), ' components.'
+
+    # Reassign the pixels of the bad components to the closest centroid of a good bin
+    bad = numpy.where(binclass < 0)[0]
+    if len(bad) > 0:
+        print len(bad), ' pixels of bad components reassigned'
+        xbar, ybar = wvt_bin_quantities(binclass[binclass >= 0], x[binclass >= 0],
+                                        y[binclass >= 0], nbins=nbins)[4:6]
+        binclass[bad] = wvt_assign_all_to_bins(x[bad], y[bad], xbar, ybar, 1.)
+
+    area = numpy.bincount(binclass, minlength=nbins)
+    xbar, ybar, binsignal, binnoise, binSN = compute_bin_quantities(x, y, signal, noise, binclass)
+
+    nvalid, averageSN, scatter_target, scatter_average = \
+        wvt_binning_statistics(binSN, area, targetSN, valid_SN, valid_area)
+    print '----------------------------------------------------'
+    print 'Binning results:'
+    print '     Valid bins:     %i/%i = %.2f%%' %(nvalid, nbins, float(nvalid)/float(nbins)*100.)
+    print '     average S/N:    %.2f'    %(averageSN)
+    print '     S/N scatter around target S/N:  %.2f %%' %(scatter_target*100.)
+    print '----------------------------------------------------'
+
+    return binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale
+
+def quadtree_binning(x, y, signal, noise, targetSN, valid_SN, valid_area):
+# Quick-look alternative to wvt_binning: the field is split recursively into
+# quadrants, each quadrant on its own merits. The sub-quadrants of a quadrant
+# that reach targetSN are split further. The ones that do not are merged into
+# one bin if they reach targetSN together and touch each other, otherwise
+# their pixels are assigned to the closest centroid of the bins at the end.
+# A quadrant without any sub-quadrant that reaches targetSN is a bin, or is
+# cut into two halves if both of them reach targetSN.
+# The pixels are sorted once along a Z-order (Morton) curve, on which every
+# quadrant of every level is a contiguous range, so each level of the
+# pyramid costs O(npix) and the whole binning O(npix log npix). Quadrants at
+# the border only hold the pixels of the field, so its size does not have to
+# be a power of two.
+# Returns the same quantities as wvt_binning, with the centroids as
+# generators and the scale lengths sqrt(area/SN) of the bins.
+
+    npix = len(x)
+
+    # prevent division by zero for pixels with noise = 0
+    noise[numpy.where(noise == 0)] = numpy.min(noise[numpy.where(noise > 0)])*1e-9
+
+    # Z-order code of the pixels relative to the lower left corner
+    xr = numpy.asarray(x-numpy.min(x), dtype=numpy.int64)
+    yr = numpy.asarray(y-numpy.min(y), dtype=numpy.int64)
+    nlevels = int(max(numpy.max(xr), numpy.max(yr), 1)).bit_length()
+    code = numpy.zeros(npix, dtype=numpy.int64)
+    for bit in range(nlevels):
+        code |= ((xr >> bit) & 1) << (2*bit)
+        code |= ((yr >> bit) & 1) << (2*bit+1)
+    order  = numpy.argsort(code, kind='mergesort')
+    code   = code[order]
+    ssort  = numpy.asarray(signal, dtype=numpy.float)[order]
+    n2sort = numpy.asarray(noise, dtype=numpy.float)[order]**2
+
+    # top-down: binsort is the bin of the sorted pixels (-1: not yet binned or
+    # left over), openpix the pixels of the quadrants that are split further
+    binsort = numpy.zeros(npix, dtype=numpy.int)-1
+    openpix = numpy.arange(npix)
+    nbins   = 0
+    olderr = numpy.seterr(divide='ignore', invalid='ignore')
+    for level in range(nlevels, 0, -1):
+        if len(openpix) == 0: break
+        # signal and noise**2 of the sub-quadrants (children) of the open
+        # quadrants (parents), as arrays (parent, child 0-3)
+        child  = code[openpix] >> (2*level-2)
+        cstart = numpy.where(numpy.concatenate(([True], child[1:] != child[:-1])))[0]
+        clen   = numpy.diff(numpy.append(cstart, len(openpix)))
+        cparent = child[cstart] >> 2
+        pstart = numpy.where(numpy.concatenate(([True], cparent[1:] != cparent[:-1])))[0]
+        nparent = len(pstart)
+        cpidx  = numpy.repeat(numpy.arange(nparent), numpy.diff(numpy.append(pstart, len(cstart))))
+        cq     = child[cstart] & 3
+        csig   = numpy.zeros((nparent, 4))
+        cn2    = numpy.zeros((nparent, 4))
+        csig[cpidx, cq] = numpy.add.reduceat(ssort[openpix], cstart)
+        cn2[cpidx, cq]  = numpy.add.reduceat(n2sort[openpix], cstart)
+        good   = csig/numpy.sqrt(cn2) >= targetSN
+        psplit = numpy.any(good, axis=1)
+        label  = numpy.zeros((nparent, 4), dtype=numpy.int)-1
+
+        # a parent without a good child is a bin, or two bins if both of its
+        # halves (children 0+1 and 2+3, or 0+2 and 1+3) reach targetSN
+        halfsn = []
+        for half in ([0, 1], [0, 2]):
+            other = [3-half[1], 3-half[0]]
+            halfsn.append(numpy.minimum(
+                numpy.sum(csig[:, half], axis=1)/numpy.sqrt(numpy.sum(cn2[:, half], axis=1)),
+                numpy.sum(csig[:, other], axis=1)/numpy.sqrt(numpy.sum(cn2[:, other], axis=1))))
+        halfsn  = numpy.nan_to_num(numpy.array(halfsn))
+        halves  = ~psplit & (numpy.max(halfsn, axis=0) >= targetSN)
+        whole   = ~psplit & ~halves
+        label[whole] = (numpy.cumsum(whole)-1+nbins)[whole, None]
+        nbins  += numpy.sum(whole)
+        first   = numpy.cumsum(2*halves)-2+nbins
+        side    = numpy.where(halfsn[0] >= halfsn[1], numpy.arange(4)[:, None] >> 1,
+                                                      numpy.arange(4)[:, None] & 1).T
+        label[halves] = (first[:, None]+side)[halves]
+        nbins  += 2*numpy.sum(halves)
+
+        # the bad children of a split parent form one bin if they reach
+        # targetSN together and are not only two diagonal quadrants,
+        # otherwise they are left over
+        bad    = psplit[:, None] & ~good & (cn2 > 0)
+        gsn    = numpy.sum(csig*bad, axis=1)/numpy.sqrt(numpy.sum(cn2*bad, axis=1))
+        gmask  = numpy.sum(bad*(1 << numpy.arange(4)), axis=1)
+        gbin   = (gsn >= targetSN) & (gmask != 6) & (gmask != 9)
+        label[bad & gbin[:, None]] = (numpy.cumsum(gbin)-1+nbins)[numpy.where(bad & gbin[:, None])[0]]
+        nbins += numpy.sum(gbin)
+
+        binsort[openpix] = numpy.repeat(label[cpidx, cq], clen)
+        openpix = openpix[numpy.repeat(good[cpidx, cq], clen)]
+    numpy.seterr(**olderr)
+
+    # quadrants that are still open at the lowest level are single pixels
+    binsort[openpix] = numpy.arange(len(openpix))+nbins
+    nbins += len(openpix)
+
+    binclass = numpy.zeros(npix, dtype=numpy.int)
+    binclass[order] = binsort
+
+    # Reassign the left over pixels to the closest centroid of a bin
+    bad = numpy.where(binclass < 0)[0]
+    if len(bad) > 0:
+        print len(bad), ' left over pixels reassigned'
+        xbar, ybar = wvt_bin_quantities(binclass[binclass >= 0], x[binclass >= 0],
+                                        y[binclass >= 0], nbins=nbins)[4:6]
+        binclass[bad] = wvt_assign_all_to_bins(x[bad], y[bad], xbar, ybar, 1.)
+
+    xbar, ybar, binsignal, binnoise, binSN = compute_bin_quantities(x, y, signal, noise, binclass)
+    area  = numpy.bincount(binclass)
+    xnode = numpy.copy(xbar)
+    ynode = numpy.copy(ybar)
+    scale = numpy.sqrt(area/numpy.abs(binSN))
+
+    nbins = len(xnode)
+    nvalid, averageSN, scatter_target, scatter_average = \
+        wvt_binning_statistics(binSN, area, targetSN, valid_SN, valid_area)
+    print '----------------------------------------------------'
+    print 'Quadtree binning results:'
+    print '     Bins:           %i'    %(nbins)
+    print '     Valid bins:     %i/%i = %.2f%%' %(nvalid, nbins, float(nvalid)/float(nbins)*100.)
+    print '     average S/N:    %.2f'  %(averageSN)
+    print '     S/N scatter around target S/N:  %.2f %%' %(scatter_target*100.)
     print '----------------------------------------------------'
 
     return binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale
@@ -991,41 +2019,494 @@ def wvt_binning(x, y, signal, noise, targetSN , dens,
 def binning_fits(signalfile, noisefile, targetSN, outfile_prefix, full_output=True,
                  pixelSize=1., center=[], dens=[], max_area=0, max_iter=0,
                  noise_mode='sig', gersho=False, quiet=False, plot=False,
-                 valid_out=0, valid_SN=0, valid_area=0):
+                 valid_out=0, valid_SN=0, valid_area=0,
+                 save_all='', save_every=10, resume='', incremental=False,
+                 warm_start='', fits_output=False, mask='', compact=False,
+                 components=False, nworkers=0, coarse=1, refine_iter=10, mode='wvt',
+                 nlevels=1, full_every=10, telemetry=None):
 # read fits files and calls adaptive binning algorithmus
+# save_all / resume: checkpoint file of the WVT iteration, True stands for
+# outfile_prefix+'.voronoi.checkpoint.npz'
+# warm_start: previous binning to start from (see wvt_binning), True stands
+# for outfile_prefix+'.voronoi.bin.dat'
+# fits_output: also store the results in outfile_prefix+'.voronoi.fits'
+# mask, compact: selection of the valid pixels and their data types (see
+# read_binning_input)
+# components=True: bin the connected components of the pixel mask separately
+# on nworkers processes (see wvt_binning_components); save_all, resume,
+# warm_start and plot are not used then
+# coarse: block size of the coarse binning used as start (see wvt_binning)
+# refine_iter: maximal number of WVT iterations after the coarse start
+# nlevels, full_every: reassigned bin neighbors and iterations between full
+# reassignments with incremental=True (see wvt_equal_mass)
+# mode: 'wvt' for the WVT binning or 'quadtree' for the quick-look binning of
+# quadtree_binning, which writes the same outputs
+# telemetry: callback for the timing of the phases (see wvt_binning), here
+# also for input, output and the quadtree or components binning
+# returns the results of wvt_binning
+
+    start = time.time()
+    x, y, signal, noise, size = read_binning_input(signalfile, noisefile, noise_mode,
+                                                   mask, compact)
+
+    print len(x)
+    start = wvt_telemetry_phase(telemetry, 'input', start, pixels=len(x))
 
-    datasignal = read_fits(signalfile)[1]
-    datanoise  = read_fits(noisefile)[1]
-    if (noise_mode == 'var'): datanoise = numpy.sqrt(datanoise)
-
-    size   = datasignal.shape
-    npix   = numpy.sum(datasignal != 0)
-    y      = numpy.zeros(npix, dtype=numpy.int)
-    x      = numpy.zeros(npix, dtype=numpy.int)
-    signal = numpy.zeros(npix, dtype=numpy.float)
-    noise  = numpy.zeros(npix, dtype=numpy.float)
-
-    print npix
-
-    n = 0
-    for i in range(size[0]):
-        for k in range(size[1]):
-            if datasignal[i,k] != 0:
-                y[n] = i
-                x[n] = k
-                signal[n] = datasignal[i,k]
-                noise[n]  = datanoise[i,k]
-                n += 1
+    if valid_SN   == 0: valid_SN   = 0.8*targetSN
+    if valid_area == 0: valid_area = 1.2*max_area
+    if save_all is True: save_all = outfile_prefix+'.voronoi.checkpoint.npz'
+    if resume   is True: resume   = outfile_prefix+'.voronoi.checkpoint.npz'
+    if warm_start is True: warm_start = outfile_prefix+'.voronoi.bin.dat'
+
+    if mode == 'quadtree':
+        binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale = \
+            quadtree_binning(x, y, signal, noise, targetSN, valid_SN, valid_area)
+        start = wvt_telemetry_phase(telemetry, 'quadtree', start)
+    elif mode != 'wvt':
+        raise ValueError("mode must be 'wvt' or 'quadtree'")
+    elif components == True:
+        if save_all or resume or warm_start or plot:
+            print 'Warning: save_all, resume, warm_start and plot are not used for components'
+        binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale = \
+            wvt_binning_components(x, y, signal, noise, targetSN, gersho, max_area, max_iter,
+                                   valid_SN, valid_area, incremental, nworkers, dens=dens,
+                                   pixelSize=pixelSize, center=center, quiet=quiet,
+                                   coarse=coarse, refine_iter=refine_iter,
+                                   nlevels=nlevels, full_every=full_every,
+                                   telemetry=telemetry)
+        start = wvt_telemetry_phase(telemetry, 'components', start)
+    else:
+        binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale = \
+            wvt_binning(x, y, signal, noise, targetSN, dens,
+                        pixelSize, center, gersho, max_area, max_iter, quiet, plot,
+                        valid_SN, valid_area, save_all, save_every, resume, incremental,
+                        warm_start=warm_start, coarse=coarse, refine_iter=refine_iter,
+                        nlevels=nlevels, full_every=full_every, telemetry=telemetry)
+        start = time.time()
+
+    write_binning_results(x, y, signal, noise, outfile_prefix, size, binclass,
+                          xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale,
+                          full_output, valid_out, valid_SN, valid_area, fits_output)
+    wvt_telemetry_phase(telemetry, 'output', start)
+
+    return binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale
+
+def read_batch_manifest(filename):
+# reads a manifest of binning jobs for binning_batch. Each line contains
+#     signalfile  noisefile  targetSN  [outfile_prefix]  [keyword=value ...]
+# where the keywords are options of binning_fits, e.g. max_area=3000 gersho=True.
+# Lines starting with '#' are ignored, an outfile_prefix of '-' is replaced
+# by the default name (see binning_batch).
+
+    jobs = []
+    for line in open(filename):
+        words = line.split('#')[0].split()
+        if len(words) == 0: continue
+        job = {'signalfile': words[0], 'noisefile': words[1],
+               'targetSN': float(words[2]), 'outfile_prefix': '-', 'options': {}}
+        for word in words[3:]:
+            if '=' in word:
+                key, value = word.split('=', 1)
+                try:
+                    value = ast.literal_eval(value)
+                except (ValueError, SyntaxError):
+                    pass        # keep strings like noise_mode=var
+                job['options'][key] = value
+            else:
+                job['outfile_prefix'] = word
+        jobs.append(job)
+
+    return jobs
+
+def _binning_batch_job(job):
+# runs one job of binning_batch in a worker process. The output of the binning
+# goes to outfile_prefix+'.voronoi.log', errors (also in opening the log) are
+# returned, not raised.
+
+    result = {'outfile_prefix': job['outfile_prefix'], 'targetSN': job['targetSN'],
+              'status': 'failed', 'time': 0., 'nbins': 0, 'nvalid': 0,
+              'averageSN': numpy.nan, 'scatter': numpy.nan, 'error': ''}
+
+    options = dict(job['options'])
+    options['plot'] = False
+    options.setdefault('quiet', True)
+
+    stdout = sys.stdout
+    log = None
+    start = time.time()
+    try:
+        # inside the try, so that e.g. a missing output directory only fails this job
+        log = open(job['outfile_prefix']+'.voronoi.log', 'w')
+        sys.stdout = log
+        binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale = \
+            binning_fits(job['signalfile'], job['noisefile'], job['targetSN'],
+                         job['outfile_prefix'], **options)
+        # the same limits as in wvt_binning, where max_area = 0 stands for
+        # the number of pixels
+        max_area   = options.get('max_area', 0)
+        valid_SN   = options.get('valid_SN', 0)
+        valid_area = options.get('valid_area', 0)
+        if max_area   == 0: max_area   = len(binclass)
+        if valid_SN   == 0: valid_SN   = 0.8*job['targetSN']
+        if valid_area == 0: valid_area = 1.2*max_area
+        nvalid, averageSN, scatter = wvt_binning_statistics(binSN, area, job['targetSN'],
+                                                            valid_SN, valid_area)[:3]
+        if not (numpy.isfinite(averageSN) and numpy.isfinite(scatter)):
+            print 'Warning: no valid bin with more than one pixel, the average S/N'
+            print 'and the S/N scatter of the summary are undefined'
+        result.update(status='ok', nbins=len(xnode), nvalid=nvalid,
+                      averageSN=averageSN, scatter=scatter)
+    except Exception:
+        result['error'] = traceback.format_exc()
+        print result['error']
+    result['time'] = time.time()-start
+    sys.stdout = stdout
+    if log is not None: log.close()
+
+    return result
+
+def binning_batch(manifest, nworkers=0, summary_file='voronoi_batch.summary.dat'):
+# Runs many binning_fits jobs on a pool of nworkers processes (0: one per CPU).
+# manifest is a manifest file (see read_batch_manifest) or a list of jobs,
+# i.e. dicts with the keys signalfile, noisefile, targetSN and optionally
+# outfile_prefix and options (keywords for binning_fits).
+# Jobs without outfile_prefix are named <signalfile without .fits>_sn<targetSN>,
+# with _<job number> appended if the name is already taken. A failed job does
+# not stop the others. The runtime, number of bins and S/N scatter of each job
+# are written to summary_file, the list of results is returned.
+
+    if isinstance(manifest, str): jobs = read_batch_manifest(manifest)
+    else:                         jobs = [dict(job) for job in manifest]
+
+    prefixes = set()
+    for i, job in enumerate(jobs):
+        job.setdefault('options', {})
+        prefix = job.get('outfile_prefix', '-')
+        if prefix == '-':
+            prefix = os.path.splitext(job['signalfile'])[0]+'_sn%g' %(job['targetSN'])
+            if prefix in prefixes: prefix += '_%i' %(i+1)
+        job['outfile_prefix'] = prefix
+        prefixes.add(prefix)
+
+    if nworkers == 0: nworkers = multiprocessing.cpu_count()
+    nworkers = max(1, min(nworkers, len(jobs)))
+    print 'running %i binning jobs on %i processes' %(len(jobs), nworkers)
+
+    pool = multiprocessing.Pool(nworkers, maxtasksperchild=1)
+    results = []
+    try:
+        for i, result in enumerate(pool.imap(_binning_batch_job, jobs)):
+            print 'job %3i | %-8s | %8.1f s | %s' %(i+1, result['status'], result['time'],
+                                                     result['outfile_prefix'])
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    table_file = open(summary_file, 'w')
+    table_file.write('# job  status      time[s]   nbins  nvalid    targetSN   averageSN   scatter[%]  outfile_prefix\n')
+    for i, result in enumerate(results):
+        table_file.write('%5i  %-8s %10.2f %7i %7i %11.2f %11.2f %12.2f  %s\n'
+                         %(i+1, result['status'], result['time'], result['nbins'], result['nvalid'],
+                           result['targetSN'], result['averageSN'], result['scatter']*100.,
+                           result['outfile_prefix']))
+    table_file.close()
+    print 'summary of the binning jobs stored in '+summary_file
+
+    return results
+
+def _binning_ladder_job(args):
+# bins the pixels for one target S/N of binning_ladder in a worker process.
+# The output goes to outfile_prefix+'.voronoi.log', errors (also in opening the
+# log) are returned, not raised, as in _binning_batch_job.
+
+    x, y, signal, noise, size, neighborlist, targetSN, outfile_prefix, options = args
+
+    result = {'outfile_prefix': outfile_prefix, 'targetSN': targetSN, 'status': 'failed',
+              'time': 0., 'nbins': 0, 'error': ''}
+
+    stdout = sys.stdout
+    log = None
+    start = time.time()
+    try:
+        log = open(outfile_prefix+'.voronoi.log', 'w')
+        sys.stdout = log
+        valid_SN   = 0.8*targetSN
+        valid_area = 1.2*options['max_area']
+        binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale = \
+            wvt_binning(x, y, signal, noise.copy(), targetSN, options['dens'],
+                        options['pixelSize'], options['center'], options['gersho'],
+                        options['max_area'], options['max_iter'], options['quiet'], False,
+                        valid_SN, valid_area, incremental=options['incremental'],
+                        neighborlist=neighborlist)
+
+        write_binning_results(x, y, signal, noise, outfile_prefix, size, binclass,
+                              xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale,
+                              options['full_output'], options['valid_out'], valid_SN, valid_area,
+                              options['fits_output'])
+        result.update(status='ok', nbins=len(xnode))
+    except Exception:
+        result['error'] = traceback.format_exc()
+        print result['error']
+    finally:
+        result['time'] = time.time()-start
+        sys.stdout = stdout
+        if log is not None: log.close()
+
+    return result
+
+def binning_ladder(signalfile, noisefile, targetSNs, outfile_prefix, nworkers=0,
+                   full_output=True, pixelSize=1., center=[], dens=[], max_area=0,
+                   max_iter=0, noise_mode='sig', gersho=False, quiet=True,
+                   valid_out=0, incremental=False, fits_output=False, mask='',
+                   compact=False):
+# Bins the same field for a list of target S/N values. The input pixels and
+# the neighbor list are prepared only once, and the targets are binned in
+# parallel on nworkers processes (0: one per CPU). The results for each target
+# are stored with the prefix outfile_prefix+'_sn<targetSN>' (see
+# write_binning_results), the log of each run in <prefix>.voronoi.log.
+# A failed target does not stop the others. Returns a list of results with
+# the keys outfile_prefix, targetSN, status ('ok' or 'failed'), time, nbins
+# and error (the traceback of a failed target).
+# The keywords are the same as in binning_fits.
+
+    x, y, signal, noise, size = read_binning_input(signalfile, noisefile, noise_mode,
+                                                   mask, compact)
+    print len(x), ' pixels'
+
+    print '...making neighbor list...'
+    neighborlist = wvt_make_neighborlist(x, y)
+
+    options = {'full_output': full_output, 'pixelSize': pixelSize, 'center': center,
+               'dens': dens, 'max_area': max_area, 'max_iter': max_iter,
+               'gersho': gersho, 'quiet': quiet, 'valid_out': valid_out,
+               'incremental': incremental, 'fits_output': fits_output}
+    jobs = [(x, y, signal, noise, size, neighborlist, float(targetSN),
+             outfile_prefix+'_sn%g' %(targetSN), options) for targetSN in targetSNs]
+
+    if nworkers == 0: nworkers = multiprocessing.cpu_count()
+    nworkers = max(1, min(nworkers, len(jobs)))
+    print 'binning for %i target S/N values on %i processes' %(len(jobs), nworkers)
+
+    pool = multiprocessing.Pool(nworkers)
+    try:
+        results = pool.map(_binning_ladder_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    for result in results:
+        print '%-30s | %-8s | %6i bins | %8.1f s' %(result['outfile_prefix'], result['status'],
+                                                     result['nbins'], result['time'])
+        if result['status'] != 'ok':
+            print result['error'].strip().splitlines()[-1]
+
+    return results
+
+def _wvt_bin_group_job(args):
+# bins one group of pixels for _wvt_bin_groups in a worker process. Returns
+# None if the bin accretion finds no good bin in the group (e.g. a thin
+# filament whose bins stay below the S/N limit), like a group that does not
+# reach targetSN at all
+
+    x, y, signal, noise, dens, center, targetSN, options = args
+
+    # the telemetry callback stays in the main process, the records of the
+    # group are returned with the result
+    records = []
+    if options.get('telemetry'): telemetry = records.append
+    else:                        telemetry = None
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale = \
+            wvt_binning(x, y, signal, noise, targetSN, dens, options.get('pixelSize', 1.),
+                        center, options['gersho'], options['max_area'], options['max_iter'],
+                        options.get('quiet', True), False, 0.8*targetSN,
+                        1.2*options['max_area'], incremental=options['incremental'],
+                        coarse=options.get('coarse', 1),
+                        refine_iter=options.get('refine_iter', 10),
+                        nlevels=options.get('nlevels', 1),
+                        full_every=options.get('full_every', 10), telemetry=telemetry)
+    except NoBinError:
+        return None, records
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    return (binclass, xnode, ynode, scale), records
+
+def _wvt_bin_groups(x, y, signal, noise, groups, targetSN, options, pool,
+                    dens=[], center=[], telemetry=None):
+# bins each group of pixels (list of index arrays) independently on the
+# process pool and returns for every group the bin numbers of its pixels,
+# generators and scale lengths, or None if the group cannot reach targetSN
+# or the bin accretion finds no good bin in it. dens (per pixel) is split
+# into the groups, center only goes to the group with the closest pixel. The
+# telemetry records of each group are passed on with its number 'component'.
+
+    results = [None]*len(groups)
+    todo = [i for i in range(len(groups))
+            if add_signal(signal[groups[i]])/add_noise(noise[groups[i]]) >= targetSN]
+
+    groupdens   = [dens[g] if len(dens) == len(x) else [] for g in groups]
+    groupcenter = [[] for g in groups]
+    if len(center) == 2:
+        closest = numpy.argmin((y-center[0])**2 + (x-center[1])**2)
+        for i, g in enumerate(groups):
+            if numpy.any(g == closest): groupcenter[i] = center
+
+    options = dict(options, telemetry=telemetry is not None)
+    jobs = ((x[groups[i]], y[groups[i]], signal[groups[i]], noise[groups[i]], groupdens[i],
+             groupcenter[i], targetSN, options) for i in todo)
+    for i, (result, records) in zip(todo, pool.imap(_wvt_bin_group_job, jobs)):
+        results[i] = result
+        for record in records:
+            record['component'] = i
+            telemetry(record)
+
+    return results
+
+def _wvt_add_bins(binclass, nodes, groups, results):
+# adds the bins of the groups binned by _wvt_bin_groups to the global bin
+# numbers binclass and the list of (xnode, ynode, scale) of all bins
+
+    nbins = sum(len(node[0]) for node in nodes)
+    for g, result in zip(groups, results):
+        if result is None: continue
+        groupclass, groupxnode, groupynode, groupscale = result
+        binclass[g] = groupclass+nbins
+        nodes.append((groupxnode, groupynode, groupscale))
+        nbins += len(groupxnode)
+
+    return nbins
+
+def _wvt_label_groups(x, y, size, select, cut=None):
+# groups the selected pixels into connected components (4-connectivity),
+# leaving out the pixels in the boolean image cut. Returns a list of index
+# arrays into x, y.
+
+    image = numpy.zeros(size, dtype=bool)
+    image[y[select], x[select]] = True
+    if cut is not None: image[cut] = False
+    labels, nlabels = ndimage.label(image)
+
+    label = labels[y, x]
+    label[~select] = 0
+    ind   = numpy.where(label > 0)[0]
+    ind   = ind[numpy.argsort(label[ind], kind='mergesort')]
+    first = numpy.searchsorted(label[ind], numpy.arange(1, nlabels+2))
+
+    return [ind[first[i]:first[i+1]] for i in range(nlabels)]
+
+def binning_tiled(signalfile, noisefile, targetSN, outfile_prefix, tile_size=512,
+                  overlap=64, nworkers=0, full_output=True, max_area=0, max_iter=0,
+                  noise_mode='sig', gersho=False, valid_out=0, valid_SN=0, valid_area=0,
+                  incremental=False, fits_output=False, mask='', compact=False):
+# Tiled binning for fields too large for a single binning run. The field is
+# split into tiles of tile_size x tile_size pixels, which are binned with an
+# additional border of overlap pixels in nworkers processes (0: one per CPU).
+# Only the bins lying completely inside their tile are kept. The remaining
+# seam pixels are split into connected components, with boxes of +-overlap
+# pixels around the tile corners cut out, and these are binned again in
+# parallel; then the pixels left over around the corners. Pixels that still
+# cannot form a bin with targetSN are assigned to the closest generator, as
+# in wvt_reassign_bad_bins. The results carry one global bin numbering and
+# are stored as by binning_fits.
+# Each worker only holds the pixels of one tile (or seam component); the
+# tiles should be several bin diameters larger than overlap.
+
+    start = time.time()
+    x, y, signal, noise, size = read_binning_input(signalfile, noisefile, noise_mode,
+                                                   mask, compact)
+    npix = len(x)
+    print npix, ' pixels'
 
     if valid_SN   == 0: valid_SN   = 0.8*targetSN
     if valid_area == 0: valid_area = 1.2*max_area
 
-    binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale = \
-        wvt_binning(x, y, signal, noise, targetSN, dens,
-                    pixelSize, center, gersho, max_area, max_iter, quiet, plot,
-                    valid_SN, valid_area)
+    # prevent division by zero for pixels with noise = 0
+    noise[numpy.where(noise == 0)] = numpy.min(noise[numpy.where(noise > 0)])*1e-9
+
+    options = {'max_area': max_area, 'max_iter': max_iter, 'gersho': gersho,
+               'incremental': incremental}
+
+    binclass = numpy.zeros(npix, dtype=numpy.int)-1
+    nodes = []
+
+    if nworkers == 0: nworkers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(nworkers, maxtasksperchild=1)
+    try:
+        # 1. bin the tiles with their borders, keep the bins inside the tile
+        tiles = []
+        for y0 in range(0, size[0], tile_size):
+            for x0 in range(0, size[1], tile_size):
+                tiles.append((x0, y0))
+        print len(tiles), ' tiles of ', tile_size, 'x', tile_size, ' pixels'
+        groups  = [numpy.where((x >= x0-overlap) & (x < x0+tile_size+overlap) &
+                               (y >= y0-overlap) & (y < y0+tile_size+overlap))[0]
+                   for x0, y0 in tiles]
+        results = _wvt_bin_groups(x, y, signal, noise, groups, targetSN, options, pool)
+        for i, (x0, y0) in enumerate(tiles):
+            if results[i] is None: continue
+            g = groups[i]
+            groupclass, groupxnode, groupynode, groupscale = results[i]
+            outside = (x[g] < x0) | (x[g] >= x0+tile_size) | (y[g] < y0) | (y[g] >= y0+tile_size)
+            keep = numpy.bincount(groupclass, weights=outside, minlength=len(groupxnode)) == 0
+            renumber = numpy.cumsum(keep)-1
+            inside = keep[groupclass]
+            groups[i]  = g[inside]
+            results[i] = (renumber[groupclass[inside]], groupxnode[keep],
+                          groupynode[keep], groupscale[keep])
+        nbins = _wvt_add_bins(binclass, nodes, groups, results)
+        print nbins, ' bins inside the tiles.'
+
+        # 2. bin the seams between the tiles without the corners
+        cut = numpy.zeros(size, dtype=bool)
+        for yc in range(tile_size, size[0], tile_size):
+            for xc in range(tile_size, size[1], tile_size):
+                cut[max(yc-overlap, 0):yc+overlap, max(xc-overlap, 0):xc+overlap] = True
+        groups = _wvt_label_groups(x, y, size, binclass < 0, cut)
+        print numpy.sum(binclass < 0), ' seam pixels in ', len(groups), ' components'
+        results = _wvt_bin_groups(x, y, signal, noise, groups, targetSN, options, pool)
+        _wvt_add_bins(binclass, nodes, groups, results)
+
+        # 3. bin the rest around the corners
+        groups = _wvt_label_groups(x, y, size, binclass < 0)
+        print numpy.sum(binclass < 0), ' corner pixels in ', len(groups), ' components'
+        results = _wvt_bin_groups(x, y, signal, noise, groups, targetSN, options, pool)
+        _wvt_add_bins(binclass, nodes, groups, results)
+    finally:
+        pool.close()
+        pool.join()
+
+    if len(nodes) == 0:
+        raise ValueError('Not enough S/N in the whole set of pixels for a single bin')
+    xnode, ynode, scale = [numpy.concatenate(node) for node in zip(*nodes)]
+
+    # 4. remaining pixels go to the closest generator
+    bad = numpy.where(binclass < 0)[0]
+    print len(bad), ' pixels assigned to the closest bin'
+    if len(bad) > 0:
+        binclass[bad] = wvt_assign_all_to_bins(x[bad], y[bad], xnode, ynode, 1.)
+
+    area = numpy.bincount(binclass, minlength=len(xnode))
+    xbar, ybar, binsignal, binnoise, binSN = compute_bin_quantities(x, y, signal, noise, binclass)
+
+    nvalid, averageSN, scatter_target, scatter_average = \
+        wvt_binning_statistics(binSN, area, targetSN, valid_SN, valid_area)
+    print '----------------------------------------------------'
+    print 'Tiled binning results:'
+    print '     Bins:           %i' %(len(xnode))
+    print '     Valid bins:     %i/%i = %.2f%%' %(nvalid, len(xnode), float(nvalid)/float(len(xnode))*100.)
+    print '     average S/N:    %.2f'    %(averageSN)
+    print '     S/N scatter around target S/N:  %.2f %%' %(scatter_target*100.)
+    print '     time:           %.1f s' %(time.time()-start)
+    print '----------------------------------------------------'
 
     write_binning_results(x, y, signal, noise, outfile_prefix, size, binclass,
                           xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale,
-                          full_output, valid_out, valid_SN, valid_area)
+                          full_output, valid_out, valid_SN, valid_area, fits_output)
 
+    return binclass, xnode, ynode, xbar, ybar, binsignal, binnoise, binSN, area, scale
@@ -1,7 +1,11 @@
-import voronoi_new
+import io
+import os
+import muse_slab_pipeline
+import muse_spaxel_store
+import muse_voronoi_bin as voronoi_new
 import numpy
 from astropy.io import fits as pyfits
-from scipy import ndimage
+from scipy import ndimage, sparse
 
 name='A2597'
 input_cube='../%s.final.fits'%name
@@ -9,68 +13,277 @@ continuum_signal_band=(6000,6200)
 target_sn=100
 max_area=3000
 
-hdu = pyfits.open(input_cube)
-data = hdu[0].data
-select = numpy.isnan(data)
-data[select] = 0
-error = numpy.sqrt(hdu[1].data)
-error[select]=1e9
-hdr = hdu[0].header
-wave = numpy.arange(hdr['NAXIS3'])*1.25 + hdr['CRVAL3']
-hdu.close()
-select_wave = (wave>continuum_signal_band[0])  & (wave<continuum_signal_band[1])
-mean_img = numpy.mean(data[select_wave,:,:],0)
-err_img = numpy.std(data[select_wave,:,:],0)
-
-# Mask that lower point source
-mean_img[256:321,38:87]=0
-hdu = pyfits.PrimaryHDU(mean_img)
-hdu.writeto('signal_cont.fits',clobber=True)
-
-hdu = pyfits.PrimaryHDU(err_img)
-hdu.writeto('noise_cont.fits',clobber=True)
-
-voronoi_new.binning_fits('signal_cont.fits','noise_cont.fits',target_sn,name,max_area=max_area,gersho=True,plot=False)
-
-def bin_cube(voronoi_pixel,input_cube,output_rss):
-  hdu = pyfits.open(input_cube)
-  data = hdu[0].data
-  select = numpy.isnan(data)
-  data[select] = 0
-  error = numpy.sqrt(hdu[1].data)
-  error[select]=1e9
+def cube_wavelength_step(hdr):
+  # wavelength step of a cube from the spectral WCS of its header (CD3_3 or CDELT3)
+  return hdr.get('CD3_3',hdr.get('CDELT3',1.))
+
+def cube_wavelength(hdr):
+  # wavelengths of the channels of a cube from the spectral WCS of its header (CRVAL3, CRPIX3 and the step)
+  return (numpy.arange(hdr['NAXIS3'])+1.-hdr.get('CRPIX3',1.))*cube_wavelength_step(hdr) + hdr['CRVAL3']
+
+def band_maps(input_cube,windows,slab=64,nworkers=0):
+  # mean signal, standard deviation and noise of the mean (propagated from the variance) of input_cube in each
+  # wavelength window (lower,upper), as a list of (signal,std,noise) images. Only the channels inside a window are
+  # read, in a single pass of muse_slab_pipeline; NaN data count as 0 with no variance. Data and variance are taken
+  # from the DATA and STAT extensions of MUSE cubes, otherwise from the first two HDUs (see cube_extensions).
+  hdu = pyfits.open(input_cube,memmap=False)
+  ext_data,ext_var = muse_spaxel_store.cube_extensions(hdu)
+  wave = cube_wavelength(hdu[ext_data].header)
+  channels = [numpy.nonzero((wave>lower) & (wave<upper))[0] for lower,upper in windows]
+  for (lower,upper),c in zip(windows,channels):
+    if len(c) == 0:
+      raise ValueError('no channels of %s in the window %g-%g'%(input_cube,lower,upper))
+
+  def window_moments(start,stop,slabs):
+    moments = {}
+    for i,c in enumerate(channels):
+      c = c[(c>=start) & (c<stop)]-start
+      if len(c):
+        data = numpy.array(slabs[0][c],dtype=numpy.float64)
+        var = numpy.array(slabs[1][c],dtype=numpy.float64)
+        bad = numpy.isnan(data)
+        data[bad] = 0
+        var[bad | numpy.isnan(var)] = 0
+        moments[i] = muse_slab_pipeline.slab_moments(start,stop,data)+(var.sum(0),)
+    return moments
+
+  totals = {}
+  read = muse_slab_pipeline.section_reader(hdu[ext_data],hdu[ext_var])
+  ranges = muse_slab_pipeline.channel_ranges(numpy.concatenate(channels),slab)
+  for start,stop,moments in muse_slab_pipeline.map_slabs(read,window_moments,ranges,nworkers):
+    for i,m in moments.items():
+      if i in totals:
+        totals[i] = muse_slab_pipeline.merge_moments(totals[i][:3],m[:3])+(totals[i][3]+m[3],)
+      else:
+        totals[i] = m
+  hdu.close()
+
+  maps = []
+  for i in range(len(windows)):
+    n,mean,m2,varsum = totals[i]
+    maps.append((mean.astype(numpy.float32),numpy.sqrt(m2/n).astype(numpy.float32),(numpy.sqrt(varsum)/n).astype(numpy.float32)))
+  return maps
+
+def write_band_maps(prefix,windows,maps,noise='noise'):
+  # writes the band_maps to prefix.<lower>-<upper>.signal/std/noise.fits and returns the (signalfile,noisefile) pairs
+  # for binning_fits, with the std (scatter per channel) or the noise of the mean as noise file
+  files = []
+  for (lower,upper),images in zip(windows,maps):
+    names = ['%s.%g-%g.%s.fits'%(prefix,lower,upper,kind) for kind in ('signal','std','noise')]
+    for filename,image in zip(names,images):
+      pyfits.PrimaryHDU(image).writeto(filename,clobber=True)
+    files.append((names[0],names[2] if noise == 'noise' else names[1]))
+  return files
+
+def bin_operator(x,y,binNr,shape):
+  # sparse (bins x spaxels) matrix which sums the spaxels (y*nx+x) of each bin (binNr starts at 1)
+  nbins = numpy.max(binNr)
+  spax = numpy.asarray(y,dtype=numpy.int64)*shape[1]+x
+  return sparse.csr_matrix((numpy.ones(len(spax)),(numpy.asarray(binNr,dtype=numpy.int64)-1,spax)),shape=(nbins,shape[0]*shape[1]))
+
+def bin_spectra(operator,data,var):
+  # sums the spectra of data (nwave,ny,nx) and the variances var of each bin, one wavelength plane at a time
+  nwave = data.shape[0]
+  data = data.reshape(nwave,-1)
+  var = var.reshape(nwave,-1)
+  op = operator.astype(numpy.float32)
+  rss_data = numpy.zeros((nwave,operator.shape[0]),dtype=numpy.float32)
+  rss_var = numpy.zeros((nwave,operator.shape[0]),dtype=numpy.float32)
+  for w in range(nwave):
+    d = numpy.array(data[w],dtype=numpy.float32)
+    v = numpy.array(var[w],dtype=numpy.float32)
+    bad = numpy.isnan(d)
+    d[bad] = 0
+    v[bad] = 1e18
+    rss_data[w] = op.dot(d)
+    rss_var[w] = op.dot(v)
+  return numpy.ascontiguousarray(rss_data.T),numpy.ascontiguousarray(rss_var.T)
+
+def rss_headers(hdr,nbins,nwave):
+  # headers of the data, error and mask extensions of a (nbins x nwave) rss, as written by astropy for the cube header hdr
+  rss = pyfits.HDUList([pyfits.PrimaryHDU(numpy.zeros((1,1),dtype=numpy.float32)),pyfits.ImageHDU(numpy.zeros((1,1),dtype=numpy.float32),name='ERROR'),pyfits.ImageHDU(numpy.zeros((1,1),dtype=numpy.uint16),name='MASK')])
+  step,start = cube_wavelength_step(hdr),cube_wavelength(hdr)[0]
+  rss[0].header = hdr.copy()
+  rss[0].header['CDELT1'] = step
+  rss[0].header['CRVAL1'] = start
+  rss[0].header['CRPIX1'] = 1
+  buf = io.BytesIO()
+  rss.writeto(buf,output_verify='fix')
+  buf.seek(0)
+  headers = [h.header for h in pyfits.open(buf)]
+  for h in headers:
+    h['NAXIS1'] = nwave
+    h['NAXIS2'] = nbins
+  return headers
+
+def create_rss(output_rss,headers):
+  # writes output_rss with the given headers and zero filled data units, returns the byte offsets of the data units
+  offsets = []
+  f = open(output_rss,'wb')
+  for h in headers:
+    f.write(h.tostring().encode('ascii'))
+    offsets.append(f.tell())
+    row = numpy.zeros(h['NAXIS1'],dtype='>i%i'%(abs(h['BITPIX'])//8))
+    if h.get('BZERO',0):
+      row -= int(h['BZERO'])
+    for i in range(h['NAXIS2']):
+      f.write(row.tostring())
+    f.write('\0'*(-f.tell()%2880))
+  f.close()
+  return offsets
+
+def read_pixel_table(voronoi_pixel,origin=0):
+  # x, y (counting from 0) and binNr of the spaxels of a .voronoi.pixel.dat or .voronoi.fits table
+  # origin: coordinate of the first spaxel in voronoi_pixel (1 for tables counting from 1)
+  x,y,binclass = voronoi_new.read_binning_pixels(voronoi_pixel)
+  return x-origin,y-origin,binclass+1
+
+def open_rss(output_rss,hdr,nbins,nwave):
+  # preallocates output_rss for the cube header hdr and returns its data and error units as writable memmaps
+  offsets = create_rss(output_rss,rss_headers(hdr,nbins,nwave))
+  rss_data = numpy.memmap(output_rss,dtype='>f4',mode='r+',offset=offsets[0],shape=(nbins,nwave))
+  rss_error = numpy.memmap(output_rss,dtype='>f4',mode='r+',offset=offsets[1],shape=(nbins,nwave))
+  return rss_data,rss_error
+
+def bin_slabs(hdu,operator,rss_data,rss_error,rows=slice(None),slab=64,nworkers=0):
+  # bins the cube of the open hdu (data, variance) with operator and writes the spectra to the given rows of
+  # rss_data and rss_error. The cube is read in slabs of slab wavelengths, which are binned on nworkers threads
+  # (0: one per CPU) of a muse_slab_pipeline
+
+  def bin_slab(start,stop,slabs):
+    slab_data,slab_var = bin_spectra(operator,slabs[0],slabs[1])
+    slab_error = numpy.sqrt(slab_var)
+    slab_error[numpy.isnan(slab_error)]=1e9
+    return slab_data,slab_error
+
+  read = muse_slab_pipeline.section_reader(hdu[0],hdu[1])
+  for start,stop,(slab_data,slab_error) in muse_slab_pipeline.slab_map(read,bin_slab,0,rss_data.shape[1],slab,nworkers):
+    rss_data[rows,start:stop] = slab_data
+    rss_error[rows,start:stop] = slab_error
+
+def bin_cube(voronoi_pixel,input_cube,output_rss,origin=0,slab=64,nworkers=0):
+  # origin: coordinate of the first spaxel in voronoi_pixel (1 for tables counting from 1)
+  # the cube is binned in slabs (see bin_slabs), which are written straight into the memory mapped output_rss
+  hdu = pyfits.open(input_cube,memmap=False)
   hdr = hdu[0].header
-  wave = numpy.arange(hdr['NAXIS3'])*1.25 + hdr['CRVAL3']
+  x,y,binNr = read_pixel_table(voronoi_pixel,origin)
+
+  operator = bin_operator(x,y,binNr,(hdr['NAXIS2'],hdr['NAXIS1']))
+  rss_data,rss_error = open_rss(output_rss,hdr,operator.shape[0],hdr['NAXIS3'])
+  bin_slabs(hdu,operator,rss_data,rss_error,slab=slab,nworkers=nworkers)
+  rss_data.flush()
+  rss_error.flush()
+  del rss_data,rss_error
   hdu.close()
 
-  ascii_in = open(voronoi_pixel,'r')
-  lines = ascii_in.readlines()
-  x = numpy.arange(len(lines)-1,dtype=numpy.int16)
-  y = numpy.arange(len(lines)-1,dtype=numpy.int16)
-  binNr = numpy.arange(len(lines)-1,dtype=numpy.int16)
-  for i in range(1,len(lines)):
-    line = lines[i].split()
-    x[i-1]=int(line[0])
-    y[i-1]=int(line[1])
-    binNr[i-1]=int(line[2])
-
-  rss_data = numpy.zeros((max(binNr),len(wave)),dtype=numpy.float32)
-  rss_error = numpy.zeros((max(binNr),len(wave)),dtype=numpy.float32)
-
-  for l in range(max(binNr)):
-    select_bin = binNr==(l+1)
-    x_bin = x[select_bin]-1
-    y_bin = y[select_bin]-1
-    for j in range(len(x_bin)):
-	  rss_data[l,:] += data[:,y_bin[j],x_bin[j]]
-	  rss_error[l,:] += error[:,y_bin[j],x_bin[j]]**2
-    rss_error[l,:] = numpy.sqrt(rss_error[l,:])
-  rss_error[numpy.isnan(rss_error)]=1e9
-  rss_out = pyfits.HDUList([pyfits.PrimaryHDU(rss_data),pyfits.ImageHDU(rss_error,name='ERROR'),pyfits.ImageHDU(numpy.zeros(rss_data.shape,dtype=numpy.uint16),name='MASK')])
-  rss_out[0].header = hdr
-  rss_out[0].header['CDELT1'] = 1.25
-  rss_out[0].header['CRVAL1'] = hdr['CRVAL3']
-  rss_out[0].header['CRPIX1'] = 1
-  rss_out.writeto(output_rss,clobber=True,output_verify='fix')
-
-bin_cube('%s.voronoi.pixel.dat'%(name),input_cube,'%s.voronoi_rss.fits'%(name))
+bin_status = ('unchanged','merged','split','changed','empty')
+
+def compare_bins(x,y,binNr,xold,yold,binNrold):
+  # classifies the bins of a new pixel table against those of the previous one (bins counted from 0, i.e. binNr-1):
+  #   0 unchanged: exactly the spaxels of one old bin
+  #   1 merged:    the union of two or more complete old bins
+  #   2 split:     part of a single old bin
+  #   3 changed:   anything else, including new spaxels
+  #   4 empty:     no spaxels (a gap in the numbering)
+  # Returns the status of each new bin, the old bin of the unchanged bins (-1 otherwise) and the distinct pairs of
+  # new and old bins sharing spaxels with the number of shared spaxels (new, old, count)
+  binclass = binNr-1
+  areaold = numpy.bincount(binNrold-1)
+  match = voronoi_new.wvt_match_pixels(x,y,xold,yold)
+  binclassold = numpy.where(match >= 0,binNrold[match]-1,-1)
+  partner = voronoi_new.wvt_compare_binclass(binclass,binclassold,areaold)
+
+  nbins = numpy.max(binNr)
+  matched = binclassold >= 0
+  pairs,count = numpy.unique(binclass[matched]*len(areaold)+binclassold[matched],return_counts=True)
+  pnew = pairs//len(areaold)
+  pold = pairs%len(areaold)
+  area = numpy.bincount(binclass,minlength=nbins)
+  shared = numpy.bincount(binclass[matched],minlength=nbins)
+  nold_per_new = numpy.bincount(pnew,minlength=nbins)
+  nnew_per_old = numpy.bincount(pold,minlength=len(areaold))
+  # number of old bins of each new bin, which lie completely inside of it
+  complete = numpy.bincount(pnew[count == areaold[pold]],minlength=nbins)
+
+  status = numpy.zeros(nbins,dtype=numpy.int8)+3
+  inside = shared == area
+  status[inside & (nold_per_new >= 2) & (complete == nold_per_new)] = 1
+  split = numpy.zeros(nbins,dtype=bool)
+  split[pnew] = nnew_per_old[pold] >= 2
+  status[inside & (nold_per_new == 1) & split] = 2
+  status[partner >= 0] = 0
+  status[area == 0] = 4
+  return status,partner,(pnew,pold,count)
+
+def bin_cube_incremental(voronoi_pixel,voronoi_pixel_old,rss_old,input_cube,output_rss,mapping_file='',origin=0,slab=64,nworkers=0):
+  # bin_cube after a re-binning, reusing the rss_old of the previous pixel table voronoi_pixel_old (see compare_bins):
+  # unchanged bins are copied from rss_old, merged bins are summed from their old bins, and only the split and
+  # changed bins are binned from the cube, which is not read at all if there are none. Empty bins stay zero. The pairs of new and old bins
+  # sharing spaxels are written to mapping_file (default: output_rss with .map.dat instead of .fits)
+  if os.path.abspath(rss_old) == os.path.abspath(output_rss):
+    raise ValueError('output_rss must not overwrite rss_old')
+  if mapping_file == '':
+    mapping_file = os.path.splitext(output_rss)[0]+'.map.dat'
+  x,y,binNr = read_pixel_table(voronoi_pixel,origin)
+  xold,yold,binNrold = read_pixel_table(voronoi_pixel_old,origin)
+  status,partner,(pnew,pold,count) = compare_bins(x,y,binNr,xold,yold,binNrold)
+  print 'bins: '+', '.join(['%i %s'%(numpy.sum(status == i),bin_status[i]) for i in range(len(bin_status))])
+
+  # new bins without any old spaxels are listed with the old bin 0
+  alone = numpy.nonzero((numpy.bincount(pnew,minlength=len(status)) == 0) & (status != 4))[0]
+  table = numpy.concatenate((numpy.column_stack((pnew+1,pold+1,count)),numpy.column_stack((alone+1,alone*0,alone*0))))
+  table = table[numpy.argsort(table[:,0],kind='mergesort')]
+  mapping = open(mapping_file,'w')
+  mapping.write('# binNr  binNr_old  shared_spaxels  status\n')
+  for new,old,shared in table:
+    mapping.write('%7i %10i %15i  %s\n'%(new,old,shared,bin_status[status[new-1]]))
+  mapping.close()
+
+  hdu = pyfits.open(input_cube,memmap=False)
+  hdr = hdu[0].header
+  hdu_old = pyfits.open(rss_old,memmap=True)
+  old_data = hdu_old[0].data
+  old_error = hdu_old[1].data
+  if old_data.shape[1] != hdr['NAXIS3']:
+    raise ValueError('%s has %i wavelengths, but %s has %i'%(rss_old,old_data.shape[1],input_cube,hdr['NAXIS3']))
+  rss_data,rss_error = open_rss(output_rss,hdr,len(status),hdr['NAXIS3'])
+
+  unchanged = numpy.nonzero(status == 0)[0]
+  rss_data[unchanged] = old_data[partner[unchanged]]
+  rss_error[unchanged] = old_error[partner[unchanged]]
+
+  # sums of the old spectra of the merged bins, with the errors added in quadrature
+  merged = status[pnew] == 1
+  if numpy.any(merged):
+    rows = numpy.unique(pnew[merged])
+    cols = numpy.unique(pold[merged])
+    operator = sparse.csr_matrix((numpy.ones(numpy.sum(merged),dtype=numpy.float32),(numpy.searchsorted(rows,pnew[merged]),numpy.searchsorted(cols,pold[merged]))),shape=(len(rows),len(cols)))
+    rss_data[rows] = operator.dot(numpy.asarray(old_data[cols],dtype=numpy.float32))
+    rss_error[rows] = numpy.sqrt(operator.dot(numpy.asarray(old_error[cols],dtype=numpy.float32)**2))
+  del old_data,old_error
+  hdu_old.close()
+
+  recompute = numpy.nonzero((status == 2) | (status == 3))[0]
+  if len(recompute):
+    select = numpy.in1d(binNr-1,recompute)
+    operator = bin_operator(x[select],y[select],binNr[select],(hdr['NAXIS2'],hdr['NAXIS1']))[recompute]
+    bin_slabs(hdu,operator,rss_data,rss_error,rows=recompute,slab=slab,nworkers=nworkers)
+  rss_data.flush()
+  rss_error.flush()
+  del rss_data,rss_error
+  hdu.close()
+
+if __name__ == '__main__':
+  mean_img,err_img,noise_img = band_maps(input_cube,[continuum_signal_band])[0]
+
+  # Mask that lower point source
+  mean_img[256:321,38:87]=0
+  hdu = pyfits.PrimaryHDU(mean_img)
+  hdu.writeto('signal_cont.fits',clobber=True)
+
+  hdu = pyfits.PrimaryHDU(err_img)
+  hdu.writeto('noise_cont.fits',clobber=True)
+
+  voronoi_new.binning_fits('signal_cont.fits','noise_cont.fits',target_sn,name,max_area=max_area,gersho=True,plot=False)
+
+  bin_cube('%s.voronoi.pixel.dat'%(name),input_cube,'%s.voronoi_rss.fits'%(name))